@@ -1,16 +1,30 @@
 from smbus import SMBus
+import os
+import sys
 import time
 
+#log_sink lives with rhok.py in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from log_sink import LogSink
+
 bus = SMBus(1)
 slaveAddress = 0x12
 data_rfA = ""
 #delayTime = 15
 
+#the log is kept open and buffered, it is flushed every 20 lines or 60 seconds
+#and rotated/compressed at 1 MB or midnight (max 50 MB on the SD card)
+#it is opened by the first log(), set logFilename before to log elsewhere
+logFilename = '/home/pi/logTest2.txt'
+logSink = None
+
 def log(data):
-	logfile = open('/home/pi/logTest2.txt','a+')
-	logfile.write(data)
-	logfile.write('\n')
-	logfile.close()
+	global logSink
+	if logSink is None:
+		logSink = LogSink(logFilename, flush_records=20, flush_interval=60)
+	if isinstance(data, list): #sendData logs the split data
+		data = ",".join(data)
+	logSink.write(data)
 	
 def getData():
 	global data_rfA
@@ -1,12 +1,37 @@
 #this will be the main code.
+import os
+import sys
 import time
+
+#adaptive_sampler and shm_snapshot live with rhok.py in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
 import Arduino_I2C_Comm as AC
 import Button_Interface as BI
 import LCD_Interface as LI
 import LED_Interface as LEDI
+import Threshold_Config as TC
+from adaptive_sampler import AdaptiveSampler
+from shm_snapshot import SnapshotWriter
 
 buttonDelay = 0.4 #0.4 seconds
-hourDelay = 30 #3600 seconds #changed in order to log every 30 seconds.
+#the data is gathered every minDelay seconds while the values are changing or
+#close to a threshold, backing off to every maxDelay seconds while stable
+minDelay = 10
+maxDelay = 600
+#data order from the Arduino, with the thresholds and sensor resolution
+sampleFields = ("water_level", "water_flow", "pH")
+sampleThresholds = {
+	"water_level" : (TC.LOW_WATER_LEVEL_THRESHOLD, None),
+	"water_flow" : (TC.LOW_WATER_FLOW_THRESHOLD, None),
+	"pH" : (TC.LOW_PH_THRESHOLD, TC.HIGH_PH_THRESHOLD),
+}
+sampleMinChange = {"water_level" : 1.0, "water_flow" : 0.5, "pH" : 0.1}
+sampler = AdaptiveSampler(minDelay, maxDelay, sampleThresholds, sampleMinChange)
+#the latest data is published in shared memory for the other local readers
+#>>> python shm_snapshot.py /dev/shm/gf_tower_snapshot
+snapshot = SnapshotWriter("/dev/shm/gf_tower_snapshot", sampleFields)
+hourDelay = minDelay
 welcomeTimeout = 10
 buttonStart = time.time()
 hourStart = time.time()
@@ -26,6 +51,24 @@ def calibratePH():
 
 def CommFailure():
 	time.sleep(8)
+
+def updateSampler(data):
+	#returns the delay until the next data gathering
+	try:
+		values = [float(v) for v in data[:len(sampleFields)]]
+	except (ValueError, TypeError):
+		return sampler.interval
+	return sampler.update(dict(zip(sampleFields, values)))
+
+lastPublished = None
+def publishSnapshot(data):
+	#only new data, getData keeps the old data when none is ready
+	global lastPublished
+	if not data or data is lastPublished:
+		return
+	lastPublished = data
+	#values that are not numbers are published as missing
+	snapshot.publish(dict(zip(sampleFields, data)))
 	
 while(1):
 
@@ -36,10 +79,12 @@ while(1):
 		try:
 			AC.getData()
 			sensor_data = AC.data_rfA
+			publishSnapshot(sensor_data)
 		except IOError:
 			print("IOError Raised")
 			CommFailure()
 		LEDI.updateLEDStatus(sensor_data)
+		hourDelay = updateSampler(sensor_data)
 		#send data
 		#global hourStart
 		hourStart = time.time()
@@ -60,6 +105,7 @@ while(1):
 					try:
 						AC.getData()
 						sensor_data = AC.data_rfA
+						publishSnapshot(sensor_data)
 					except IOError:
 						print("IOError Raised")
 						CommFailure()
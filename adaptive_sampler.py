@@ -0,0 +1,119 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Adaptive sampling interval for the sensor polling loops (see
+# RaspberryPiZeroCode/Test2.py and gf-i2c-master-test.py).
+#
+# The sampler keeps a running estimate (exponentially weighted mean and
+# variance) of each field. After each sample:
+#   -if any field moved more than 'change_sigmas' standard deviations from
+#    its running mean, or is within 'threshold_margin' of one of its
+#    thresholds, the interval drops to 'min_interval'
+#   -otherwise the interval grows by 'backoff' up to 'max_interval'
+#
+# A stable tower is polled every 'max_interval' seconds (less bus traffic,
+# cpu wake-ups and uploads) while a tower that is changing, or close to a
+# threshold, is polled every 'min_interval' seconds.
+#
+# Note: This file is also imported by the python 2 code on the pi zero, keep
+# it python 2 and 3 compatible.
+#
+##########################################################################
+# Usage:
+# >>> sampler = AdaptiveSampler(10, 300, thresholds={'pH' : (5.0, 7.0)})
+# >>> while True:
+# ...     values = read_sensors()   # ie. {'pH' : 6.5, 'water_level' : 80.0}
+# ...     time.sleep(sampler.update(values))
+#
+##########################################################################
+
+
+import math
+
+
+DFLT_ALPHA = 0.2
+DFLT_CHANGE_SIGMAS = 3.0
+DFLT_THRESHOLD_MARGIN = 0.1     # 10% of the threshold value
+DFLT_BACKOFF = 1.5
+
+
+class FieldEstimate(object):
+    """Exponentially weighted running mean/variance of a single field."""
+
+    def __init__(self, value):
+        self.mean = value
+        self.var = 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.var)
+
+    def update(self, value, alpha):
+        diff = value - self.mean
+        incr = alpha * diff
+        self.mean += incr
+        self.var = (1.0 - alpha) * (self.var + diff * incr)
+
+
+class AdaptiveSampler(object):
+    """Computes the next sampling interval from the latest sample.
+
+    'thresholds' maps a field name to a (low, high) tuple, either can be
+    None. 'min_change' maps a field name to the smallest change that counts
+    as a change (ie. the sensor's resolution), it defaults to 0.
+    """
+
+    def __init__(self, min_interval, max_interval, thresholds=None,
+            min_change=None, alpha=DFLT_ALPHA,
+            change_sigmas=DFLT_CHANGE_SIGMAS,
+            threshold_margin=DFLT_THRESHOLD_MARGIN, backoff=DFLT_BACKOFF):
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.thresholds = thresholds or {}
+        self.min_change = min_change or {}
+        self.alpha = alpha
+        self.change_sigmas = change_sigmas
+        self.threshold_margin = threshold_margin
+        self.backoff = backoff
+
+        self.interval = self.min_interval
+        self.estimates = {}
+
+    def is_changing(self, field, value):
+        estimate = self.estimates.get(field)
+        if estimate is None: return True
+        limit = max(self.change_sigmas * estimate.std,
+                self.min_change.get(field, 0.0))
+        return abs(value - estimate.mean) > limit
+
+    def is_near_threshold(self, field, value):
+        low, high = self.thresholds.get(field, (None, None))
+        if low is not None and value <= low + self.threshold_margin * abs(low):
+            return True
+        if (high is not None and
+                value >= high - self.threshold_margin * abs(high)):
+            return True
+        return False
+
+    def update(self, values):
+        """Updates the estimates with a sample, a dict of field name to
+        number. Returns the interval (seconds) until the next sample.
+        """
+        active = False
+        for field, value in values.items():
+            if (self.is_changing(field, value) or
+                    self.is_near_threshold(field, value)):
+                active = True
+
+            estimate = self.estimates.get(field)
+            if estimate is None:
+                self.estimates[field] = FieldEstimate(value)
+            else:
+                estimate.update(value, self.alpha)
+
+        if active:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval,
+                    self.interval * self.backoff)
+        return self.interval
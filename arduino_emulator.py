@@ -0,0 +1,557 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Virtual arduino, used to run and measure rhok.py, Arduino_I2C_Comm and
+# gf-i2c-master-test.py without the hardware.
+#
+# -SerialEmulator: a pseudo terminal (pty) that sends the csv sensor lines
+#  read by rhok.sensor_loop at a configurable rate, with timing jitter and
+#  corrupted lines (truncated, garbage, missing fields, bad values).
+# -FakeSMBus: drop-in replacement of smbus.SMBus with one FakeArduino per
+#  address. It speaks both protocols of the arduino-i2c sketches:
+#    -commands 1-6 (gf-rhok.ino, gf-i2c-master-test.py):
+#     read_i2c_block_data(address, cmd) returns one sensor value
+#    -ready/request/ack (Arduino_I2C_Comm, i2c_bus.py): read_byte() is 1 when
+#     data is ready, write_byte(1) requests it, read_i2c_block_data(address,
+#     0, 30) reads it, write_byte(3) acks. write_byte(4) then
+#     write_i2c_block_data() sends data to the arduino.
+#  install_fake_smbus() registers it as the 'smbus' module.
+# -Record/replay: record the lines of a real arduino serial port with their
+#  timing, replay them through the pty at 1x or faster. The raw bytes (line
+#  noise and line endings included) are recorded escaped and replayed as-is.
+#  SMBus traffic can be recorded with RecordingSMBus and answered back with
+#  ReplaySMBus.
+#
+# Note: Keep this file python 2 and 3 compatible, so it can also be used by
+# the python 2 code on the pi zero.
+#
+##########################################################################
+# Usage:
+# Emulate an arduino on a pty, 10 lines/s with 5% corrupted lines. The pty
+# device name is printed, use it as the config file arduino 'serial_port'.
+# >>> python3 arduino_emulator.py serial --rate 10 --corruption 0.05
+#
+# Record a real arduino for an hour, then replay it 60 times faster.
+# >>> python3 arduino_emulator.py record /dev/ttyACM1 --out tower.tsv \
+#         --duration 3600
+# >>> python3 arduino_emulator.py replay tower.tsv --speed 60
+#
+# Run the pi zero code against a fake I2C bus.
+# >>> import arduino_emulator
+# >>> arduino_emulator.install_fake_smbus()
+# >>> import Arduino_I2C_Comm
+#
+##########################################################################
+
+
+import argparse
+import errno
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+
+DFLT_RATE = 1.0           # lines per second
+DFLT_JITTER = 0.1         # fraction of the line interval
+DFLT_CORRUPTION = 0.0     # fraction of the lines
+
+# The serial line format, same order as rhok.FIELD_ORDER. Each field is a
+# random walk: (start, step, min, max, decimals).
+SERIAL_FIELDS = (
+        (20.0, 0.1, 8.0, 34.0, 1),     # water level sensor (distance, cm)
+        (45.0, 0.3, 0.0, 100.0, 1),    # air humidity
+        (22.0, 0.1, -10.0, 45.0, 1),   # air temperature
+        (20.0, 0.05, 0.0, 40.0, 1),    # water temperature
+        (6.5, 0.02, 0.0, 14.0, 2),     # pH
+)
+LIGHT_STATUSES = ('1', 'x', 'x', 'x')
+
+# The I2C sensor values: commands 1-5, then the water flow (l/min). The
+# ready/request/ack data is 'water_level,water_flow,pH' (see Test2.py).
+I2C_FIELDS = (
+        (60.0, 0.5, 0.0, 100.0, 0),    # water level (% of the tank)
+        (45.0, 0.3, 0.0, 100.0, 1),    # air humidity
+        (22.0, 0.1, -10.0, 45.0, 1),   # air temperature
+        (20.0, 0.05, 0.0, 40.0, 1),    # water temperature
+        (6.5, 0.02, 0.0, 14.0, 2),     # pH
+        (16.0, 0.2, 0.0, 30.0, 1),     # water flow
+)
+I2C_DATA_FIELDS = (0, 5, 4)
+
+# Corruption kinds.
+CORRUPTIONS = ('truncate', 'garbage', 'missing_field', 'bad_value',
+        'no_newline')
+
+# I2C protocol, see arduino-i2c, Arduino_I2C_Comm and i2c_bus.py.
+CMD_WATER_LEVEL = 1
+CMD_AIR_HUMIDITY = 2
+CMD_AIR_TEMP = 3
+CMD_WATER_TEMP = 4
+CMD_PH = 5
+CMD_LIGHT_STATUS = 6
+DATA_READY = 1
+REQUEST = 1
+ACK = 3
+SEND = 4
+I2C_BLOCK_MAX = 32
+NO_DATA = 255
+DATA_BLOCK_LEN = 30
+
+
+class SensorSimulator(object):
+    """Random walk sensor values, used by the serial and I2C emulators."""
+
+    def __init__(self, fields=SERIAL_FIELDS, seed=None):
+        self.fields = fields
+        self.random = random.Random(seed)
+        self.values = [f[0] for f in fields]
+
+    def step(self):
+        for i, (_, step, v_min, v_max, _) in enumerate(self.fields):
+            v = self.values[i] + self.random.uniform(-step, step)
+            self.values[i] = min(v_max, max(v_min, v))
+
+    def value_str(self, i):
+        return '{:.{}f}'.format(self.values[i], self.fields[i][4])
+
+    def line(self):
+        """Returns the next csv line (without the line ending)."""
+        self.step()
+        return ','.join([self.value_str(i) for i in range(len(self.fields))]
+                + list(LIGHT_STATUSES))
+
+
+def corrupt(line, rand):
+    """Returns a corrupted copy of a line and the kind of corruption."""
+    kind = rand.choice(CORRUPTIONS)
+    if 'truncate' == kind:
+        return line[:rand.randint(0, len(line) - 1)], kind
+    if 'garbage' == kind:
+        return ''.join(chr(rand.randint(33, 126))
+                for _ in range(rand.randint(1, 40))), kind
+    values = line.split(',')
+    if 'missing_field' == kind:
+        del values[rand.randrange(len(values))]
+    elif 'bad_value' == kind:
+        values[rand.randrange(len(SERIAL_FIELDS))] = rand.choice(
+                ('', 'nan?', '-', '1.2.3'))
+    return ','.join(values), kind
+
+
+def synthetic_lines(rate, jitter, seed=None):
+    """Yields (delay before the line, line) at 'rate' lines per second."""
+    simulator = SensorSimulator(seed=seed)
+    rand = random.Random(seed)
+    interval = 1.0 / rate
+    while True:
+        delay = interval * (1.0 + rand.uniform(-jitter, jitter))
+        yield max(0.0, delay), simulator.line()
+
+
+def escape(raw):
+    """Escapes the raw bytes read from a serial port, for a recording."""
+    return raw.decode('latin-1').encode('unicode_escape').decode('ascii')
+
+
+def unescape(s):
+    """Returns the raw bytes of a recorded line, as a latin-1 string."""
+    return s.encode('ascii', 'backslashreplace').decode('unicode_escape')
+
+
+def recorded_lines(filename, speed=1.0, loop=False):
+    """Yields (delay before the line, line) from a recording, 'speed' times
+    faster than recorded. The lines include their recorded line ending.
+    """
+    while True:
+        last = 0.0
+        with io.open(filename, encoding='utf-8', errors='replace') as fp:
+            for record in fp:
+                offset, _, line = record.rstrip('\n').partition('\t')
+                offset = float(offset)
+                yield max(0.0, (offset - last) / speed), unescape(line)
+                last = offset
+        if not loop: break
+
+
+class SerialEmulator(object):
+    """Sends lines to a pseudo terminal, like the arduino's usb serial port.
+
+    'lines' yields (delay, line) tuples, ie. synthetic_lines() or
+    recorded_lines() (with line_ending='', the recorded lines have theirs).
+    The lines are sent as latin-1, one byte per character.
+    """
+
+    def __init__(self, lines, corruption=DFLT_CORRUPTION, seed=None,
+            line_ending='\r\n'):
+        import pty
+        import tty
+
+        self.lines = lines
+        self.corruption = corruption
+        self.line_ending = line_ending
+        self.random = random.Random(seed)
+
+        self.master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self.sent = 0
+        self.corrupted = 0
+        self.write_errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Sends the lines from a background thread."""
+        self._thread = threading.Thread(target=self.run,
+                name='serial-emulator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        for delay, line in self.lines:
+            if self._stop.wait(delay): break
+            self.send(line)
+        self._stop.set()
+
+    def send(self, line):
+        ending = self.line_ending
+        if self.corruption and self.random.random() < self.corruption:
+            line, kind = corrupt(line, self.random)
+            if 'no_newline' == kind: ending = ''
+            self.corrupted += 1
+        try:
+            os.write(self.master, (line + ending).encode('latin-1',
+                'replace'))
+            self.sent += 1
+        except OSError:
+            # Nobody reading and the pty buffer is full, the arduino would
+            # lose the data too.
+            self.write_errors += 1
+
+    @property
+    def done(self):
+        return self._stop.is_set()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self._slave)
+
+
+def record_serial(device, baud_rate, filename, duration=None):
+    """Records the lines of a real serial port with their time offset, one
+    '<seconds>\t<escaped line>' per line. Returns the number of lines
+    recorded.
+    """
+    import serial
+
+    count = 0
+    ser = serial.Serial(device, baud_rate)
+    start = time.time()
+    try:
+        with open(filename, 'w') as fp:
+            while duration is None or time.time() - start < duration:
+                line = ser.readline()
+                offset = time.time() - start
+                fp.write('{:.6f}\t{}\n'.format(offset, escape(line)))
+                count += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ser.close()
+    return count
+
+
+#
+# I2C.
+#
+def i2c_error():
+    """The IOError smbus raises when a slave doesn't answer."""
+    return IOError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+
+
+def to_block(s, length, pad=NO_DATA):
+    """Pads a string to an I2C block. Reading past what the arduino wrote
+    returns NO_DATA.
+    """
+    block = [ord(c) for c in s[:length]]
+    return block + [pad] * (length - len(block))
+
+
+class FakeArduino(object):
+    """One arduino on the fake bus.
+
+    'data_interval' is how often new data is ready (ready/request/ack
+    protocol). 'error_rate' is the fraction of bus transactions that fail.
+    """
+
+    def __init__(self, data_interval=0.0, error_rate=0.0, seed=None,
+            clock=time.time):
+        self.simulator = SensorSimulator(I2C_FIELDS, seed)
+        self.random = random.Random(seed)
+        self.data_interval = data_interval
+        self.error_rate = error_rate
+        self.clock = clock
+
+        self.ready_at = clock()
+        self.requested = False
+        self.sending = False
+        self.received = []     # data written to the arduino (SEND)
+        self.transactions = 0
+
+    def _transaction(self):
+        self.transactions += 1
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise i2c_error()
+
+    def ready_data(self):
+        """The 30 character block of the ready/request/ack protocol."""
+        return ','.join(self.simulator.value_str(i) for i in I2C_DATA_FIELDS)
+
+    def command_data(self, cmd):
+        """The value returned for the gf-rhok.ino commands 1-6."""
+        s = self.simulator
+        if CMD_LIGHT_STATUS == cmd:
+            return ','.join('1' if 'x' == v else v for v in LIGHT_STATUSES)
+        if CMD_WATER_LEVEL <= cmd <= CMD_PH:
+            return s.value_str(cmd - 1)
+        return ''
+
+    def read_byte(self):
+        self._transaction()
+        if self.sending: return SEND
+        return DATA_READY if self.clock() >= self.ready_at else 0
+
+    def write_byte(self, value):
+        self._transaction()
+        if REQUEST == value:
+            self.simulator.step()
+            self.requested = True
+        elif ACK == value:
+            self.requested = False
+            self.sending = False
+            self.ready_at = self.clock() + self.data_interval
+        elif SEND == value:
+            self.sending = True
+
+    def read_block(self, cmd, length):
+        self._transaction()
+        if 0 == cmd and self.requested:
+            # Space padded to DATA_BLOCK_LEN, like sendData does (and
+            # getData strips).
+            return to_block(self.ready_data().ljust(DATA_BLOCK_LEN), length)
+        self.simulator.step()
+        return to_block(self.command_data(cmd), length)
+
+    def write_block(self, cmd, data):
+        self._transaction()
+        self.received.append((cmd, list(data)))
+        self.sending = False
+
+
+class FakeSMBus(object):
+    """Drop-in replacement of smbus.SMBus, see FakeArduino."""
+
+    def __init__(self, bus=1, devices=None):
+        self.bus = bus
+        self.devices = devices if devices is not None else {}
+
+    def _device(self, address):
+        device = self.devices.get(address)
+        if device is None: raise i2c_error()
+        return device
+
+    def read_byte(self, address):
+        return self._device(address).read_byte()
+
+    def write_byte(self, address, value):
+        self._device(address).write_byte(value)
+
+    def read_i2c_block_data(self, address, cmd, length=I2C_BLOCK_MAX):
+        return self._device(address).read_block(cmd, length)
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self._device(address).write_block(cmd, data)
+
+    def close(self):
+        pass
+
+
+def install_fake_smbus(devices=None):
+    """Registers this module as 'smbus', SMBus(n) returns a FakeSMBus with
+    'devices' (default: arduinos at the 0x08 and 0x12 addresses used by the
+    sketches). Returns the devices.
+    """
+    if devices is None: devices = {0x08 : FakeArduino(), 0x12 : FakeArduino()}
+
+    class SMBus(FakeSMBus):
+        def __init__(self, bus=1):
+            FakeSMBus.__init__(self, bus, devices)
+
+    module = type(sys)('smbus')
+    module.SMBus = SMBus
+    sys.modules['smbus'] = module
+    return devices
+
+
+class RecordingSMBus(object):
+    """Wraps a (real) SMBus and records every transaction with its time
+    offset and result as json lines.
+    """
+
+    METHODS = ('read_byte', 'write_byte', 'read_i2c_block_data',
+            'write_i2c_block_data')
+
+    def __init__(self, bus, filename):
+        self.bus = bus
+        self._fp = open(filename, 'w')
+        self._start = time.time()
+
+    def _call(self, method, *args):
+        record = {'t' : round(time.time() - self._start, 6),
+                'method' : method, 'args' : list(args)}
+        try:
+            result = getattr(self.bus, method)(*args)
+            record['result'] = result
+            return result
+        except IOError as e:
+            record['error'] = e.errno
+            raise
+        finally:
+            self._fp.write(json.dumps(record) + '\n')
+            self._fp.flush()
+
+    def read_byte(self, address):
+        return self._call('read_byte', address)
+
+    def write_byte(self, address, value):
+        return self._call('write_byte', address, value)
+
+    def read_i2c_block_data(self, address, cmd, length=I2C_BLOCK_MAX):
+        return self._call('read_i2c_block_data', address, cmd, length)
+
+    def write_i2c_block_data(self, address, cmd, data):
+        return self._call('write_i2c_block_data', address, cmd, list(data))
+
+    def close(self):
+        self._fp.close()
+
+
+class ReplaySMBus(FakeSMBus):
+    """Answers the transactions from a RecordingSMBus recording, in the
+    recorded order for each (method, address, cmd). 'speed' > 0 also replays
+    the recorded timing (blocking until the transaction's time offset).
+    """
+
+    def __init__(self, filename, speed=0.0):
+        FakeSMBus.__init__(self)
+        self.speed = speed
+        self._records = {}
+        with open(filename) as fp:
+            for line in fp:
+                record = json.loads(line)
+                self._records.setdefault(self._key(record['method'],
+                    record['args']), []).append(record)
+        self._start = time.time()
+
+    def _key(self, method, args):
+        # address (and cmd for the block reads/writes)
+        return (method,) + tuple(args[:2 if 'block' in method else 1])
+
+    def _replay(self, method, *args):
+        records = self._records.get(self._key(method, args))
+        if not records: raise i2c_error()
+        record = records.pop(0)
+        if self.speed:
+            delay = record['t'] / self.speed - (time.time() - self._start)
+            if delay > 0: time.sleep(delay)
+        if 'error' in record:
+            raise IOError(record['error'], os.strerror(record['error']))
+        return record.get('result')
+
+    def read_byte(self, address):
+        return self._replay('read_byte', address)
+
+    def write_byte(self, address, value):
+        self._replay('write_byte', address, value)
+
+    def read_i2c_block_data(self, address, cmd, length=I2C_BLOCK_MAX):
+        return self._replay('read_i2c_block_data', address, cmd, length)
+
+    def write_i2c_block_data(self, address, cmd, data):
+        self._replay('write_i2c_block_data', address, cmd, data)
+
+
+def run_serial(emulator):
+    print(emulator.port)
+    sys.stdout.flush()
+    emulator.start()
+    start = time.time()
+    try:
+        while not emulator.done: time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.time() - start
+    emulator.close()
+    print('sent {} lines ({} corrupted, {} write errors) in {:.1f}s, '
+            '{:.1f} lines/s'.format(emulator.sent, emulator.corrupted,
+                emulator.write_errors, elapsed,
+                emulator.sent / elapsed if elapsed else 0.0))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Virtual arduino.')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    p = subparsers.add_parser('serial', help='synthetic data on a pty')
+    p.add_argument('--rate', type=float, default=DFLT_RATE,
+            help='lines per second (default: %(default)s)')
+    p.add_argument('--jitter', type=float, default=DFLT_JITTER,
+            help='fraction of the line interval (default: %(default)s)')
+    p.add_argument('--corruption', type=float, default=DFLT_CORRUPTION,
+            help='fraction of corrupted lines (default: %(default)s)')
+    p.add_argument('--seed', type=int)
+
+    p = subparsers.add_parser('record', help='record a real serial port')
+    p.add_argument('device')
+    p.add_argument('--baud_rate', type=int, default=9600)
+    p.add_argument('--out', required=True)
+    p.add_argument('--duration', type=float, help='seconds')
+
+    p = subparsers.add_parser('replay', help='replay a recording on a pty')
+    p.add_argument('recording')
+    p.add_argument('--speed', type=float, default=1.0,
+            help='replay speed, 1 is real time (default: %(default)s)')
+    p.add_argument('--loop', action='store_true')
+    p.add_argument('--corruption', type=float, default=DFLT_CORRUPTION)
+    p.add_argument('--seed', type=int)
+
+    args = parser.parse_args(argv)
+
+    if 'serial' == args.mode:
+        run_serial(SerialEmulator(synthetic_lines(args.rate, args.jitter,
+            args.seed), args.corruption, args.seed))
+    elif 'record' == args.mode:
+        count = record_serial(args.device, args.baud_rate, args.out,
+                args.duration)
+        print('recorded {} lines to {}'.format(count, args.out))
+    elif 'replay' == args.mode:
+        run_serial(SerialEmulator(recorded_lines(args.recording, args.speed,
+            args.loop), args.corruption, args.seed, line_ending=''))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
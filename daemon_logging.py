@@ -0,0 +1,164 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Logging setup for the long running scripts (ie. rhok.sensor_loop).
+#
+# -Leveled logging with the standard 'logging' module. Use lazy formatting,
+#  ie. log.debug('row %s', row) and not log.debug('row {}'.format(row)), the
+#  message is only formatted if the record is actually output.
+# -Structured output: 'level=... logger=... msg="..."' plus any key/values
+#  passed with extra={'fields' : {...}}. No timestamps when running under
+#  systemd, journald already adds them.
+# -Rate limiting: at most 'burst' records per message (its format string)
+#  every 'period' seconds. The next record that gets through reports how many
+#  were suppressed, ie. 'suppressed=812'.
+# -Debug ring buffer: the last 'ring_size' debug records are kept in memory
+#  and only output (before the record) when an error is logged.
+#
+# Note: Keep this file python 2 and 3 compatible, so it can also be used by
+# the python 2 code on the pi zero.
+#
+##########################################################################
+# Usage:
+# >>> setup_logging('INFO')
+# >>> log = logging.getLogger('rhok')
+# >>> log.warning('Sensor data length mismatch, received %d values', n)
+#
+##########################################################################
+
+
+import collections
+import logging
+import os
+import sys
+
+
+DFLT_LEVEL = 'INFO'
+DFLT_RING_SIZE = 200
+DFLT_RATE_LIMIT_PERIOD = 60.0   # seconds
+DFLT_RATE_LIMIT_BURST = 5
+
+# Set by systemd when stdout/stderr are connected to the journal.
+JOURNAL_STREAM_ENV = 'JOURNAL_STREAM'
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Formats records as key=value pairs."""
+
+    def __init__(self, with_time=True):
+        logging.Formatter.__init__(self)
+        self.with_time = with_time
+
+    def format(self, record):
+        parts = []
+        if self.with_time:
+            parts.append('time={}'.format(self.formatTime(record)))
+        parts.append('level={}'.format(record.levelname))
+        parts.append('logger={}'.format(record.name))
+        parts.append('msg="{}"'.format(record.getMessage()))
+
+        fields = getattr(record, 'fields', None)
+        if fields:
+            for key, value in sorted(fields.items()):
+                parts.append('{}={}'.format(key, value))
+
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed: parts.append('suppressed={}'.format(suppressed))
+
+        s = ' '.join(parts)
+        if record.exc_info:
+            s = '{}\n{}'.format(s, self.formatException(record.exc_info))
+        return s
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most 'burst' records per message through every 'period'
+    seconds. Errors and above are never suppressed.
+    """
+
+    def __init__(self, period=DFLT_RATE_LIMIT_PERIOD,
+            burst=DFLT_RATE_LIMIT_BURST):
+        logging.Filter.__init__(self)
+        self.period = period
+        self.burst = burst
+        # key -> [window start, count in window, suppressed]
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR: return True
+
+        # The format string (not the formatted message) identifies similar
+        # records, it's cheap and doesn't format the message.
+        key = (record.name, record.levelno, record.msg)
+        now = record.created
+        window = self._windows.get(key)
+
+        if window is None or now - window[0] >= self.period:
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed: record.suppressed = suppressed
+            return True
+
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+
+        window[2] += 1
+        return False
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last 'capacity' records, they are passed on to 'target' only
+    when a record of 'flush_level' or above is logged.
+    """
+
+    def __init__(self, target, capacity=DFLT_RING_SIZE,
+            flush_level=logging.ERROR):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.target = target
+        self.flush_level = flush_level
+        self.buffer = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        if record.levelno >= self.flush_level:
+            self.dump()
+        elif record.levelno < self.target.level:
+            # Only keep what the target won't output anyway.
+            self.buffer.append(record)
+
+    def dump(self):
+        """Outputs (and clears) the buffered records."""
+        while self.buffer:
+            record = self.buffer.popleft()
+            # Bypass the target's level, these are the debug records.
+            self.target.acquire()
+            try:
+                self.target.emit(record)
+            finally:
+                self.target.release()
+
+
+def setup_logging(level=DFLT_LEVEL, ring_size=DFLT_RING_SIZE,
+        rate_limit_period=DFLT_RATE_LIMIT_PERIOD,
+        rate_limit_burst=DFLT_RATE_LIMIT_BURST, stream=None):
+    """Configures the root logger. Returns the output handler."""
+    if isinstance(level, str): level = logging.getLevelName(level.upper())
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setLevel(level)
+    handler.setFormatter(KeyValueFormatter(
+        with_time=JOURNAL_STREAM_ENV not in os.environ))
+    handler.addFilter(RateLimitFilter(rate_limit_period, rate_limit_burst))
+
+    root = logging.getLogger()
+    for h in list(root.handlers): root.removeHandler(h)
+
+    if ring_size and level > logging.DEBUG:
+        # The debug records are created but only kept in the ring buffer.
+        # Added first so they are output before the error that dumps them.
+        root.addHandler(RingBufferHandler(handler, ring_size))
+        root.setLevel(logging.DEBUG)
+    else:
+        root.setLevel(level)
+    root.addHandler(handler)
+    return handler
@@ -1,8 +1,36 @@
 import smbus
 import time
+from adaptive_sampler import AdaptiveSampler
 bus = smbus.SMBus(1)
 address = 0x8
 
+# Poll every MIN_INTERVAL seconds while the values are changing, backing off
+# to every MAX_INTERVAL seconds while they are stable.
+MIN_INTERVAL = 1
+MAX_INTERVAL = 60
+# Smallest change that counts (roughly the sensor resolution).
+MIN_CHANGE = {
+    'water_level' : 1.0,
+    'air_humidity' : 1.0,
+    'air_temp' : 0.5,
+    'water_temp' : 0.5,
+    'pH' : 0.1,
+}
+sampler = AdaptiveSampler(MIN_INTERVAL, MAX_INTERVAL, min_change=MIN_CHANGE)
+
+def toSampleValues(readings):
+    values = {}
+    for name, reading in readings:
+        parts = reading.split(',')
+        for i, v in enumerate(parts):
+            # ie. the light status '1,0,1,1' -> light_status_1 ... _4
+            key = name if 1 == len(parts) else '{}_{}'.format(name, i + 1)
+            try:
+                values[key] = float(v)
+            except ValueError:
+                pass
+    return values
+
 def querySensor(address, cmd):
     try:
         sensor_data = bus.read_i2c_block_data(address, cmd)
@@ -32,4 +60,13 @@ while True:
     print("pH: " + pH)
     print("Light Status: " + lightStatus)
 
-    time.sleep(1)
+    interval = sampler.update(toSampleValues((
+        ('water_level', waterLevel),
+        ('air_humidity', airHumidity),
+        ('air_temp', airTemperature),
+        ('water_temp', waterTemperature),
+        ('pH', pH),
+        ('light_status', lightStatus),
+    )))
+    print("Next poll in: {:.1f}s".format(interval))
+    time.sleep(interval)
@@ -0,0 +1,281 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# I2C bus manager used to poll several arduinos (slaves) on one raspberry pi
+# bus, each mapped to its own tower tags.
+#
+# Each slave uses the ready/request/read/ack protocol of
+# RaspberryPiZeroCode/Arduino_I2C_Comm.getData:
+#   1. read_byte()                  1 when new data is ready
+#   2. write_byte(REQUEST)          ask for the data
+#   3. wait PREPARE_TIME            the arduino prepares the data
+#   4. read_i2c_block_data(0, 30)   read the csv data
+#   5. write_byte(ACK)
+#
+# Instead of blocking the whole bus during step 3 (like getData does), every
+# slave has its own state and due time. The manager runs whichever phase is
+# due next, so the slaves' prepare times overlap and one slow arduino doesn't
+# hold up the others. Each bus transaction is done while holding 'bus_lock'.
+#
+# A slave that fails (IOError) is retried with an exponential backoff, its
+# health (errors, last success) is tracked per slave.
+#
+# Note: Keep this file python 2 and 3 compatible, so it can also be used by
+# the python 2 code on the pi zero.
+#
+##########################################################################
+# Usage:
+# Find the slaves on the bus.
+# >>> python3 i2c_bus.py --discover
+#
+# Poll the slaves listed in the config file "i2c_slaves" section, ie.
+# "i2c_slaves" : [
+#     {"address" : 18, "tags" : {"towerName" : "Tower_60", ...}},
+#     {"address" : 19, "tags" : {"towerName" : "Tower_61", ...}}
+# ]
+# >>> python3 i2c_bus.py --config config.json
+#
+##########################################################################
+
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+
+log = logging.getLogger('i2c_bus')
+
+
+I2C_BUS = 1
+
+# Valid 7 bit slave addresses (0x00-0x02 and 0x78-0x7f are reserved).
+FIRST_ADDRESS = 0x03
+LAST_ADDRESS = 0x77
+
+# Protocol, see arduino-i2c and Arduino_I2C_Comm.
+DATA_READY = 1
+REQUEST = 1
+ACK = 3
+BLOCK_CMD = 0
+BLOCK_LEN = 30
+NO_DATA = 255
+
+DFLT_POLL_INTERVAL = 30.0       # seconds between readings of a slave
+DFLT_PREPARE_TIME = 5.0         # seconds the arduino needs to prepare data
+DFLT_NOT_READY_RETRY = 1.0      # seconds before asking again if not ready
+DFLT_ERROR_BACKOFF = 10.0       # first retry delay after an error
+DFLT_MAX_BACKOFF = 600.0
+
+# Slave states.
+IDLE = 'idle'
+REQUESTED = 'requested'
+
+# Config file keys.
+I2C_SLAVES = 'i2c_slaves'
+S_ADDRESS = 'address'
+S_TAGS = 'tags'
+
+# Shared by all the users of the bus (one bus transaction at a time).
+bus_lock = threading.Lock()
+
+
+def decode_block(block):
+    """Converts the bytes read from an arduino to a list of csv values."""
+    return ''.join(chr(b) for b in block if b != NO_DATA).strip().split(',')
+
+
+def discover(bus, addresses=None, lock=bus_lock):
+    """Returns the addresses of the slaves that answer on the bus."""
+    if addresses is None: addresses = range(FIRST_ADDRESS, LAST_ADDRESS + 1)
+    found = []
+    for address in addresses:
+        try:
+            with lock:
+                bus.read_byte(address)
+            found.append(address)
+        except IOError:
+            pass
+    return found
+
+
+class Slave(object):
+    """State and health of one arduino on the bus."""
+
+    def __init__(self, address, tags=None):
+        self.address = address
+        self.tags = tags or {}
+        self.state = IDLE
+        self.due = 0.0
+
+        # Health.
+        self.readings = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_success = None
+        self.last_error = None
+
+    @property
+    def healthy(self):
+        return 0 == self.consecutive_errors
+
+    def health(self):
+        return {
+                'address' : hex(self.address),
+                'state' : self.state,
+                'readings' : self.readings,
+                'errors' : self.errors,
+                'consecutive_errors' : self.consecutive_errors,
+                'last_success' : self.last_success,
+                'last_error' : self.last_error,
+        }
+
+
+class BusManager(object):
+    """Interleaves the polling of several slaves on one bus.
+
+    'on_data(slave, values)' is called with each reading, 'values' is the
+    list of csv values sent by the arduino.
+    """
+
+    def __init__(self, bus, slaves, on_data, poll_interval=DFLT_POLL_INTERVAL,
+            prepare_time=DFLT_PREPARE_TIME,
+            not_ready_retry=DFLT_NOT_READY_RETRY,
+            error_backoff=DFLT_ERROR_BACKOFF, max_backoff=DFLT_MAX_BACKOFF,
+            lock=bus_lock, clock=time.time, sleep=time.sleep):
+        self.bus = bus
+        self.slaves = list(slaves)
+        self.on_data = on_data
+        self.poll_interval = poll_interval
+        self.prepare_time = prepare_time
+        self.not_ready_retry = not_ready_retry
+        self.error_backoff = error_backoff
+        self.max_backoff = max_backoff
+        self.lock = lock
+        self.clock = clock
+        self.sleep = sleep
+        self._stop = threading.Event()
+
+    def step(self):
+        """Runs every phase that is due. Returns the time of the next due
+        phase.
+        """
+        now = self.clock()
+        for slave in self.slaves:
+            if slave.due <= now:
+                self._run_phase(slave, now)
+                now = self.clock()
+        return min(slave.due for slave in self.slaves)
+
+    def run(self):
+        """Polls the slaves until stop() is called."""
+        while not self._stop.is_set():
+            delay = self.step() - self.clock()
+            if delay > 0: self.sleep(delay)
+
+    def stop(self):
+        self._stop.set()
+
+    def health(self):
+        return [slave.health() for slave in self.slaves]
+
+    def _run_phase(self, slave, now):
+        try:
+            if IDLE == slave.state:
+                self._request(slave, now)
+            else:
+                self._read(slave, now)
+        except IOError as e:
+            self._failed(slave, now, e)
+
+    def _request(self, slave, now):
+        with self.lock:
+            ready = self.bus.read_byte(slave.address)
+            if DATA_READY == ready:
+                self.bus.write_byte(slave.address, REQUEST)
+
+        if DATA_READY == ready:
+            slave.state = REQUESTED
+            slave.due = now + self.prepare_time
+        else:
+            slave.due = now + self.not_ready_retry
+
+    def _read(self, slave, now):
+        with self.lock:
+            block = self.bus.read_i2c_block_data(slave.address, BLOCK_CMD,
+                    BLOCK_LEN)
+            self.bus.write_byte(slave.address, ACK)
+
+        slave.state = IDLE
+        slave.due = now + self.poll_interval
+        slave.readings += 1
+        slave.consecutive_errors = 0
+        slave.last_success = now
+        self.on_data(slave, decode_block(block))
+
+    def _failed(self, slave, now, e):
+        slave.errors += 1
+        slave.consecutive_errors += 1
+        slave.last_error = now
+        backoff = min(self.max_backoff,
+                self.error_backoff * 2 ** (slave.consecutive_errors - 1))
+        log.warning('I2C error on slave %s (retry in %.0fs): %s',
+                hex(slave.address), backoff, e)
+        # Start over, the arduino may have reset.
+        slave.state = IDLE
+        slave.due = now + backoff
+
+
+def create_slaves(config_data):
+    """Creates the slaves from the config data "i2c_slaves" section."""
+    return [Slave(s[S_ADDRESS], s.get(S_TAGS))
+            for s in config_data.get(I2C_SLAVES, [])]
+
+
+def print_data(slave, values):
+    print('{} {}: {}'.format(hex(slave.address), slave.tags, values))
+
+
+def main():
+    from smbus import SMBus
+
+    parser = argparse.ArgumentParser(description='Poll several arduinos on '
+            'one I2C bus.')
+    parser.add_argument('--config', default='config.json',
+            help='config file with an "i2c_slaves" section '
+            '(default: %(default)s)')
+    parser.add_argument('--discover', action='store_true',
+            help='list the slave addresses on the bus and exit')
+    parser.add_argument('--poll_interval', type=float,
+            default=DFLT_POLL_INTERVAL)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    bus = SMBus(I2C_BUS)
+
+    if args.discover:
+        print(' '.join(hex(address) for address in discover(bus)))
+        return
+
+    with open(args.config) as fp:
+        slaves = create_slaves(json.load(fp))
+    if not slaves:
+        # Default to whatever answers on the bus, tagged by address.
+        slaves = [Slave(address, {'address' : hex(address)})
+                for address in discover(bus)]
+    if not slaves:
+        log.error('No I2C slaves found')
+        return
+
+    manager = BusManager(bus, slaves, print_data,
+            poll_interval=args.poll_interval)
+    try:
+        manager.run()
+    except KeyboardInterrupt:
+        pass
+    for health in manager.health(): log.info('Slave health: %s', health)
+
+
+if '__main__' == __name__:
+    main()
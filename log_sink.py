@@ -0,0 +1,248 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Buffered, rotating log writer used to keep a local copy of the raw sensor
+# data on the SD card (see Arduino_I2C_Comm.log and rhok.sensor_loop).
+#
+# The log file is kept open and written through a buffer. The buffer is
+# flushed every 'flush_records' records or 'flush_interval' seconds
+# (whichever comes first) and can optionally be fsync'ed. The file is rotated
+# when it grows past 'max_bytes' and/or at midnight. Rotated segments are
+# gzip'ed by a background thread and the oldest segments are removed once the
+# total disk usage goes over 'max_total_bytes'.
+#
+# Note: This file is also imported by the python 2 code on the pi zero, keep
+# it python 2 and 3 compatible.
+#
+##########################################################################
+# Usage:
+# >>> sink = LogSink('/home/pi/logTest2.txt')
+# >>> sink.write('80.5,44.4,25.2,22.9,7.0,1,x,x,x')
+# >>> sink.close()
+#
+##########################################################################
+
+
+import atexit
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # python 2
+
+
+log = logging.getLogger('log_sink')
+
+
+DFLT_MAX_BYTES = 1024 * 1024               # 1 MB per segment
+DFLT_MAX_TOTAL_BYTES = 50 * 1024 * 1024    # 50 MB for all the segments
+DFLT_FLUSH_RECORDS = 20
+DFLT_FLUSH_INTERVAL = 60.0                 # seconds
+DFLT_BUFFER_SIZE = 64 * 1024
+ROTATE_RETRY_DELAY = 60.0                  # seconds, after a failed rotation
+
+# Suffix of a rotated segment, ie. logTest2.txt.20180414-063000
+SEGMENT_TIME_FORMAT = '%Y%m%d-%H%M%S'
+COMPRESSED_EXT = '.gz'
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def next_midnight(now):
+    """Returns the epoch time of the next local midnight after 'now'."""
+    t = time.localtime(now)
+    midnight = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0,
+        -1))
+    return midnight + SECONDS_PER_DAY
+
+
+def compress_file(filename):
+    """Gzip 'filename' into 'filename.gz' and remove the original."""
+    tmp_filename = filename + COMPRESSED_EXT + '.tmp'
+    with open(filename, 'rb') as f_in:
+        with gzip.open(tmp_filename, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.rename(tmp_filename, filename + COMPRESSED_EXT)
+    os.remove(filename)
+
+
+class LogSink(object):
+    """Line based log file writer. Not thread safe, use one per writer."""
+
+    def __init__(self, filename, max_bytes=DFLT_MAX_BYTES,
+            max_total_bytes=DFLT_MAX_TOTAL_BYTES, rotate_daily=True,
+            flush_records=DFLT_FLUSH_RECORDS,
+            flush_interval=DFLT_FLUSH_INTERVAL, fsync=False, compress=True,
+            buffer_size=DFLT_BUFFER_SIZE):
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.rotate_daily = rotate_daily
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.compress = compress
+        self.buffer_size = buffer_size
+
+        self._fp = None
+        self._size = 0
+        self._unflushed = 0
+        self._last_flush = time.time()
+        self._rotate_at = None
+        self._retry_at = 0.0
+        self._closed = False
+
+        # Closed segments are compressed/cleaned up in the background so the
+        # writer never waits on gzip.
+        self._jobs = queue.Queue()
+        self._worker = threading.Thread(target=self._segment_worker,
+                name='log-sink-compress')
+        self._worker.daemon = True
+        self._worker.start()
+
+        self._open()
+        atexit.register(self.close)
+
+    def _open(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._fp = open(self.filename, 'a', self.buffer_size)
+        self._size = os.path.getsize(self.filename)
+        now = time.time()
+        self._last_flush = now
+        self._rotate_at = next_midnight(now) if self.rotate_daily else None
+
+    def write(self, line):
+        """Buffer a single record. A newline is appended."""
+        if self._closed: return
+        now = time.time()
+        if now < self._retry_at:
+            # After a failed rotation: keep writing to the current segment,
+            # or drop the records if it couldn't be reopened.
+            if self._fp is None: return
+        elif self._fp is None:
+            if not self._reopen(now): return
+        elif ((self._rotate_at is not None and now >= self._rotate_at) or
+                (self.max_bytes and self._size >= self.max_bytes)):
+            self.rotate()
+            if self._fp is None: return
+
+        self._fp.write(line)
+        self._fp.write('\n')
+        self._size += len(line) + 1
+        self._unflushed += 1
+
+        if (self._unflushed >= self.flush_records or
+                now - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self, fsync=None):
+        """Flush the buffer to the os and, if configured, to the disk."""
+        if self._fp is None: return
+        self._fp.flush()
+        if self.fsync if fsync is None else fsync:
+            os.fsync(self._fp.fileno())
+        self._unflushed = 0
+        self._last_flush = time.time()
+
+    def rotate(self):
+        """Close the current segment and start a new one. If that fails the
+        current segment is kept (reopened if needed) and the rotation is
+        retried after ROTATE_RETRY_DELAY, the error is logged, not raised.
+        """
+        if self._fp is None: return
+        try:
+            self.flush(fsync=True)
+            self._fp.close()
+            self._fp = None
+
+            if self._size:
+                segment = '{}.{}'.format(self.filename,
+                        time.strftime(SEGMENT_TIME_FORMAT))
+                # Don't clobber a segment rotated in the same second.
+                n = 1
+                unique_segment = segment
+                while (os.path.exists(unique_segment) or
+                        os.path.exists(unique_segment + COMPRESSED_EXT)):
+                    unique_segment = '{}.{}'.format(segment, n)
+                    n += 1
+                os.rename(self.filename, unique_segment)
+                self._jobs.put(unique_segment)
+
+            self._open()
+        except (IOError, OSError) as e:
+            now = time.time()
+            log.error('Unable to rotate log: %s (retry in %.0fs): %s',
+                    self.filename, ROTATE_RETRY_DELAY, e)
+            self._retry_at = now + ROTATE_RETRY_DELAY
+            if self._fp is None or self._fp.closed:
+                self._fp = None
+                self._reopen(now)
+
+    def _reopen(self, now):
+        """Reopens the log after a failed rotation. Returns False (and
+        schedules a retry) if it can't be opened.
+        """
+        try:
+            self._open()
+            return True
+        except (IOError, OSError) as e:
+            log.error('Unable to reopen log: %s (retry in %.0fs): %s',
+                    self.filename, ROTATE_RETRY_DELAY, e)
+            self._fp = None
+            self._retry_at = now + ROTATE_RETRY_DELAY
+            return False
+
+    def close(self):
+        """Flush and close the log file. Waits on pending compression."""
+        if self._closed: return
+        self._closed = True
+        if self._fp is not None:
+            self.flush(fsync=True)
+            self._fp.close()
+            self._fp = None
+        self._jobs.put(None)
+        self._worker.join()
+
+    def segments(self):
+        """Returns the closed (compressed if enabled) segments, oldest
+        first.
+        """
+        directory = os.path.dirname(self.filename)
+        prefix = os.path.basename(self.filename) + '.'
+        ext = COMPRESSED_EXT if self.compress else ''
+        segments = [os.path.join(directory, name)
+                for name in os.listdir(directory)
+                if name.startswith(prefix) and name.endswith(ext) and
+                not name.endswith('.tmp')]
+        return sorted(segments, key=lambda s: (os.path.getmtime(s), s))
+
+    def _segment_worker(self):
+        while True:
+            segment = self._jobs.get()
+            if segment is None: break
+            try:
+                if self.compress: compress_file(segment)
+                self._enforce_total_size()
+            except (IOError, OSError) as e:
+                log.error('Unable to clean up log segment: %s (%s)', segment,
+                        e)
+
+    def _enforce_total_size(self):
+        if not self.max_total_bytes: return
+        segments = self.segments()
+        sizes = [os.path.getsize(segment) for segment in segments]
+        total = sum(sizes) + self._size
+
+        # Always remove the oldest segment first.
+        for segment, size in zip(segments, sizes):
+            if total <= self.max_total_bytes: break
+            os.remove(segment)
+            total -= size
@@ -14,6 +14,7 @@
 # -python 3
 # -library: pySerial - http://pyserial.readthedocs.io
 # -library: InfluxDBClient - https://pypi.python.org/pypi/influxdb
+# -daemon_logging.py, log_sink.py and sinks.py (in this directory)
 # -correct system time (for light's status)
 #
 ##########################################################################
@@ -25,6 +26,13 @@
 # Used to skip the setup.
 # >>> python3 rhok.py --skip_setup
 #
+# Startup time: the serial port is read before the db client is ready, the
+# influxdb and serial libraries are only imported when first needed and the
+# db client is created by the db sink's worker thread. The readings received
+# in the meantime wait in the sinks' queues. The time to the first reading
+# and the peak memory use are logged ('First reading'), see also
+# startup_bench.py.
+#
 ##########################################################################
 # Notes:
 # If a json dictionary key string is changed in the configuration file, the
@@ -72,15 +80,29 @@
 ##########################################################################
 
 
+# Used to report the startup time, set before the other imports.
+import time as _time
+START_TIME = _time.time()
+
+# Note: influxdb and serial (pySerial) are slow to import on a pi zero, they
+# are imported where they are used so the serial port can be read as early as
+# possible.
+from daemon_logging import setup_logging
 from datetime import datetime, time
 from enum import Enum, unique
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError
 import json
-import serial  # For communication with arduino.
+from log_sink import LogSink
+import logging
+import resource
+from shm_snapshot import DFLT_HISTORY as SN_DFLT_HISTORY, SnapshotWriter
+from sinks import (CircuitBreaker, CsvSink, FanOut, HistorySink, InfluxSink,
+        NS_PER_SECOND, SinkWorker, freeze_row, now_ns)
 import sys
 
 
+log = logging.getLogger('rhok')
+
+
 # This is our default config file. Don't write to this. Read only.
 DFLT_CONFIG_FILENAME = 'default_config.json'
 CONFIG_FILENAME = 'config.json'
@@ -98,6 +120,7 @@ SERIAL_PORT = '/dev/ttyACM1'
 # Most of the following consts are based on the strings in the config.json
 # file.
 MEASUREMENT = 'measurement'
+TIME = 'time'
 
 
 TAGS = 'tags'
@@ -115,6 +138,15 @@ DB_HOST_NAME = "host_name"
 DB_HOST_PORT = "host_port"
 DB_DBNAME = "dbname"
 DB_USERNAME = "username"
+# Optional, defaults to True. Set to false to use a local influxdb (ie. for
+# testing or an on-site relay).
+DB_SSL = "ssl"
+# Optional, seconds the db sinks wait for the db before a write fails. The
+# admin and export clients wait as long as needed.
+DB_TIMEOUT = "timeout"
+DB_DFLT_TIMEOUT = 10
+DB_DFLT_PASSWORD = 'rhokmonitoring'
+DB_DFLT_RETRIES = 3
 
 DB_ORDER = (
         DB_HOST_NAME,
@@ -126,6 +158,8 @@ DB_ORDER = (
 
 ARDUINO = 'arduino'
 A_BAUD_RATE = 'baud_rate'
+# Optional, defaults to SERIAL_PORT.
+A_SERIAL_PORT = 'serial_port'
 
 
 WATER_LEVEL = 'water_level'
@@ -152,6 +186,86 @@ LIGHT_SENSOR_ORDER = (
         LS_EXPECTED_START_OFF_MIN,
 )
 
+# Optional, used to keep a local copy of the raw lines read from the arduino.
+# An empty filename disables the raw log.
+RAW_LOG = 'raw_log'
+RL_FILENAME = 'filename'
+RL_MAX_BYTES = 'max_bytes'
+RL_MAX_TOTAL_BYTES = 'max_total_bytes'
+RL_ROTATE_DAILY = 'rotate_daily'
+RL_FLUSH_RECORDS = 'flush_records'
+RL_FLUSH_INTERVAL = 'flush_interval'
+RL_FSYNC = 'fsync'
+RL_COMPRESS = 'compress'
+
+# Maps the log config keys to the LogSink args.
+LOG_SINK_ARGS = {
+        RL_MAX_BYTES : 'max_bytes',
+        RL_MAX_TOTAL_BYTES : 'max_total_bytes',
+        RL_ROTATE_DAILY : 'rotate_daily',
+        RL_FLUSH_RECORDS : 'flush_records',
+        RL_FLUSH_INTERVAL : 'flush_interval',
+        RL_FSYNC : 'fsync',
+        RL_COMPRESS : 'compress',
+}
+
+# Optional, the outputs for the sensor data. Each sink has its own queue and
+# worker (see sinks.py). The primary db sink ('db' section above) is always
+# used, the others are enabled by setting their filename/host_name.
+SINKS = 'sinks'
+S_DB = 'db'
+S_SECONDARY_DB = 'secondary_db'   # Same keys as the 'db' section.
+S_HISTORY = 'history'             # Json lines, same keys as 'raw_log'.
+S_CSV = 'csv'
+S_FILENAME = 'filename'
+
+# Sink worker config keys, same names as the SinkWorker args.
+S_QUEUE_SIZE = 'queue_size'
+S_BATCH_SIZE = 'batch_size'
+S_MAX_RETRIES = 'max_retries'
+S_RETRY_DELAY = 'retry_delay'
+S_BACKLOG_SIZE = 'backlog_size'
+
+SINK_WORKER_KEYS = (
+        S_QUEUE_SIZE,
+        S_BATCH_SIZE,
+        S_MAX_RETRIES,
+        S_RETRY_DELAY,
+        S_BACKLOG_SIZE,
+)
+
+# Circuit breaker config keys (db sinks), same names as the CircuitBreaker
+# args.
+S_FAILURE_THRESHOLD = 'failure_threshold'
+S_RESET_TIMEOUT = 'reset_timeout'
+S_MAX_RESET_TIMEOUT = 'max_reset_timeout'
+
+BREAKER_KEYS = (
+        S_FAILURE_THRESHOLD,
+        S_RESET_TIMEOUT,
+        S_MAX_RESET_TIMEOUT,
+)
+
+# Optional, the latest readings are published in shared memory for the local
+# readers (see shm_snapshot.py). An empty path disables the snapshot.
+SNAPSHOT = 'snapshot'
+SN_PATH = 'path'
+SN_HISTORY = 'history'
+
+# Optional, logging config (see daemon_logging.py).
+LOGGING = 'logging'
+L_LEVEL = 'level'
+L_RING_SIZE = 'ring_size'
+L_RATE_LIMIT_PERIOD = 'rate_limit_period'
+L_RATE_LIMIT_BURST = 'rate_limit_burst'
+
+LOGGING_KEYS = (
+        L_LEVEL,
+        L_RING_SIZE,
+        L_RATE_LIMIT_PERIOD,
+        L_RATE_LIMIT_BURST,
+)
+
 # Used with the light sensor code.
 ARDUINO_LIGHT_ON = 1
 ARDUINO_INVALID_DATA = 'x'
@@ -225,7 +339,7 @@ def to_float(s):
         return float(s)
     except ValueError:
         # Re-raise the exception, to be caught by users of this function.
-        raise e
+        raise
 
 
 def to_int(s):
@@ -233,7 +347,7 @@ def to_int(s):
         return int(s)
     except ValueError:
         # Re-raise the exception, to be caught by users of this function.
-        raise e
+        raise
 
 
 def to_str(s): return s
@@ -304,7 +418,8 @@ def to_dict(config_data, field_dict, sensor_data):
         except ValueError as e:
             # Skip this field/data. This is most likely caused by a sensor
             # value not being as expected (ie. to_int or to_float)
-            print('Exception: {}'.format(e))
+            log.warning('Invalid sensor value (ignoring field %s): %s', field,
+                    e)
             continue
 
     d[FIELDS] = fields
@@ -315,7 +430,7 @@ def check_config_data_keys_sanity(config_data):
     """Does very basic sanity on the config data keys."""
     for key in CONFIG_KEYS:
         if key not in config_data:
-            print('ERROR: Missing config file key "{}"'.format(key))
+            log.error('Missing config file key "%s"', key)
             return False
     return True
 
@@ -326,8 +441,7 @@ def get_config_data(filename):
         with open(filename) as fp:
             config_data = json.load(fp)
     except OSError as e:
-        print('Exception: {}'.format(e))
-        print('ERROR: Unable to read config file: {}'.format(filename))
+        log.error('Unable to read config file: %s (%s)', filename, e)
         return {}
 
     if check_config_data_keys_sanity(config_data): return config_data
@@ -337,8 +451,8 @@ def get_config_data(filename):
 def update_config_data(filename, config_data):
     """Used to overwrite the json config data."""
     if not check_config_data_keys_sanity(config_data):
-        print('ERROR: Invalid config data={}, config file not updated'.format(
-            config_data))
+        log.error('Invalid config data=%s, config file not updated',
+                config_data)
         return False
 
     try:
@@ -346,8 +460,7 @@ def update_config_data(filename, config_data):
             json.dump(config_data, fp, indent=4)
             #print(json.dumps(config_data))
     except OSError as e:
-        print('Exception: {}'.format(e))
-        print('ERROR: Unable to write config file: {}'.format(filename))
+        log.error('Unable to write config file: %s (%s)', filename, e)
         return False
     return True
 
@@ -367,32 +480,130 @@ def create_sensor_field_dict(config_data):
 
 
 def config_adruino_serial_port(config_data):
+    import serial  # For communication with arduino.
+    serial_port = config_data[ARDUINO].get(A_SERIAL_PORT, SERIAL_PORT)
     try:
-        return serial.Serial(SERIAL_PORT, config_data[ARDUINO][A_BAUD_RATE])
+        return serial.Serial(serial_port, config_data[ARDUINO][A_BAUD_RATE])
     except serial.SerialException as e:
-        print('Exception: {}'.format(e))
-        print('ERROR: Unable to configure adruino serial port: {}'.format(
-            SERIAL_PORT))
+        log.error('Unable to configure adruino serial port: %s (%s)',
+                serial_port, e)
+        return None
+
+
+def config_raw_log(config_data):
+    """Returns the raw data log sink, None if it is disabled."""
+    rl_config = config_data.get(RAW_LOG, {})
+    filename = rl_config.get(RL_FILENAME)
+    if not filename: return None
+
+    kwargs = {arg : rl_config[key] for key, arg in LOG_SINK_ARGS.items()
+            if key in rl_config}
+    try:
+        return LogSink(filename, **kwargs)
+    except OSError as e:
+        log.error('Unable to open raw data log: %s (%s)', filename, e)
         return None
 
 
-def config_db_client(config_data):
+def config_snapshot(config_data):
+    """Returns the shared memory snapshot writer, None if it is disabled."""
+    sn_config = config_data.get(SNAPSHOT, {})
+    path = sn_config.get(SN_PATH)
+    if not path: return None
+
+    try:
+        return SnapshotWriter(path, FIELD_ORDER,
+                sn_config.get(SN_HISTORY, SN_DFLT_HISTORY))
+    except (IOError, OSError) as e:
+        log.error('Unable to open shared memory snapshot: %s (%s)', path, e)
+        return None
+
+
+def config_db_client(config_data, username=None, password=DB_DFLT_PASSWORD,
+        timeout=None, retries=DB_DFLT_RETRIES):
+    """Used to create the db client. 'username' defaults to the config file
+    username. 'timeout' is in seconds, None waits forever. 'retries' is the
+    number of attempts per request, 0 retries forever.
+    """
+    from influxdb import InfluxDBClient
+    from influxdb.exceptions import InfluxDBClientError
+
+    db = config_data[DB]
+    if username is None: username = db[DB_USERNAME]
     try:
         # TODO - remove password
-        db = config_data[DB]
+        ssl = db.get(DB_SSL, True)
         client = InfluxDBClient(host=db[DB_HOST_NAME], port=db[DB_HOST_PORT],
-                username=db[DB_USERNAME], password='rhokmonitoring', ssl=True,
-                verify_ssl=True)
+                username=username, password=password, ssl=ssl,
+                verify_ssl=ssl, timeout=timeout, retries=retries)
         client.switch_database(db[DB_DBNAME])
         return client
     except InfluxDBClientError as e:
-        print('Exception: {}'.format(e))
-        print('ERROR: Unable to configure influx db client: host={}, port={}, '
-            'username={}'.format(
-                db[DB_HOST_NAME], db[DB_HOST_PORT], db[DB_USERNAME]))
+        log.error('Unable to configure influx db client: host=%s, port=%s, '
+                'username=%s (%s)', db[DB_HOST_NAME], db[DB_HOST_PORT],
+                username, e)
         return None
 
 
+def config_logging(config_data):
+    """Used to (re)configure the logging from the config data."""
+    logging_config = config_data.get(LOGGING, {})
+    setup_logging(**{key : logging_config[key] for key in LOGGING_KEYS
+        if key in logging_config})
+
+
+def create_sink_worker(sink, sink_config, breaker=False):
+    kwargs = {key : sink_config[key] for key in SINK_WORKER_KEYS
+            if key in sink_config}
+    if breaker:
+        kwargs['breaker'] = CircuitBreaker(sink.name,
+                **{key : sink_config[key] for key in BREAKER_KEYS
+                    if key in sink_config})
+    return SinkWorker(sink, **kwargs)
+
+
+def config_sinks(config_data):
+    """Returns the output sink workers, the primary db is always first. The
+    db clients are created by the sink workers. The db sinks have a circuit
+    breaker, which does the retrying, so each write is attempted once, and
+    the writes time out so a hung db doesn't stall the worker.
+    """
+    sinks_config = config_data.get(SINKS, {})
+    workers = [create_sink_worker(
+        InfluxSink(S_DB, lambda: config_db_client(config_data,
+            timeout=config_data[DB].get(DB_TIMEOUT, DB_DFLT_TIMEOUT),
+            retries=1)),
+        sinks_config.get(S_DB, {}), breaker=True)]
+
+    secondary_config = sinks_config.get(S_SECONDARY_DB, {})
+    if secondary_config.get(DB_HOST_NAME):
+        db = dict(config_data[DB])
+        db.update({key : secondary_config[key]
+            for key in DB_ORDER + (DB_SSL, DB_TIMEOUT)
+            if key in secondary_config})
+        workers.append(create_sink_worker(
+            InfluxSink(S_SECONDARY_DB,
+                lambda: config_db_client({DB : db},
+                    timeout=db.get(DB_TIMEOUT, DB_DFLT_TIMEOUT), retries=1)),
+            secondary_config, breaker=True))
+
+    history_config = sinks_config.get(S_HISTORY, {})
+    if history_config.get(S_FILENAME):
+        kwargs = {arg : history_config[key]
+                for key, arg in LOG_SINK_ARGS.items() if key in history_config}
+        workers.append(create_sink_worker(
+            HistorySink(history_config[S_FILENAME], **kwargs),
+            history_config))
+
+    csv_config = sinks_config.get(S_CSV, {})
+    if csv_config.get(S_FILENAME):
+        workers.append(create_sink_worker(
+            CsvSink(csv_config[S_FILENAME], TAGS_ORDER, FIELD_ORDER),
+            csv_config))
+
+    return workers
+
+
 #
 # Functions to manage setup.
 #
@@ -515,13 +726,48 @@ def sensor_loop():
     #print(config_data)
     if not config_data: return
 
+    config_logging(config_data)
+
     field_dict = create_sensor_field_dict(config_data)
 
     ser_adruino = config_adruino_serial_port(config_data)
     if ser_adruino is None: return
 
-    db_client = config_db_client(config_data)
-    if db_client is None: return
+    # The db clients are created in the background, the readings are queued
+    # until they are ready.
+    fan_out = FanOut(config_sinks(config_data))
+    fan_out.start()
+
+    # These are optional.
+    raw_log = config_raw_log(config_data)
+    snapshot = config_snapshot(config_data)
+
+    try:
+        read_sensor_data(config_data, field_dict, ser_adruino, fan_out,
+                raw_log, snapshot)
+    finally:
+        if raw_log is not None: raw_log.close()
+        if snapshot is not None: snapshot.close()
+        fan_out.stop()
+        for name, stats in fan_out.stats().items():
+            log.info('Sink stats', extra={'fields' : dict(stats, sink=name)})
+
+
+def log_startup():
+    """Logs the time to the first reading and the peak memory use."""
+    log.info('First reading', extra={'fields' : {
+        'startup_ms' : int((_time.time() - START_TIME) * 1000),
+        'max_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }})
+
+
+def read_sensor_data(config_data, field_dict, ser_adruino, fan_out,
+        raw_log=None, snapshot=None):
+    """Loops forever reading the sensor data and publishing it to the
+    sinks and the shared memory snapshot.
+    """
+    import serial  # Already imported by config_adruino_serial_port.
+    first_reading = True
 
     while True:
         try:
@@ -529,37 +775,47 @@ def sensor_loop():
         except serial.SerialException as e:
             # One reason this can occur is when the rpi is disconnected from
             # the arduino.
-            print('Exception: {}'.format(e))
-            print('ERROR: Unable to read adruino serial port')
+            log.error('Unable to read adruino serial port (%s)', e)
             break
 
-        # Convert byte array to a string. Common separated values.
-        sensor_data = sensor_data.decode('utf-8').strip().split(',')
+        # Convert byte array to a string. Common separated values. Line noise
+        # is replaced, the line is then dropped by the length check.
+        sensor_data = sensor_data.decode('utf-8', 'replace').strip()
+        if raw_log is not None: raw_log.write(sensor_data)
+        sensor_data = sensor_data.split(',')
         #print(sensor_data)
 
         if len(sensor_data) != FIELDS_LEN:
             # This can happen once in while, especially during the first few
             # reads.
-            print('WARNING: Sensor data length mismatch (ignoring sensor '
-                    'data), received {} values, expecting {} values'.format(
-                    len(sensor_data), sensor_fields_len))
+            log.warning('Sensor data length mismatch (ignoring sensor data), '
+                    'received %d values, expecting %d values',
+                    len(sensor_data), FIELDS_LEN)
             continue
 
-        # Output to json.
-        d = [to_dict(config_data, field_dict, sensor_data)]
-        #print(json.dumps(d))
+        # Converted once, the read only row is shared by all the sinks. The
+        # time is set here as the sinks write in batches.
+        d = to_dict(config_data, field_dict, sensor_data)
+        if not d[FIELDS]:
+            # Line noise of the right length, a point without fields is
+            # rejected by influx db. Rate limited by the logging filter.
+            log.warning('No valid sensor value (ignoring sensor data)')
+            continue
+        d[TIME] = now_ns()
+        row = freeze_row(d)
+        fan_out.publish(row)
+        if snapshot is not None:
+            snapshot.publish(row[FIELDS], row[TIME] / NS_PER_SECOND)
+        # Only formatted if output, ie. dumped from the ring buffer on error.
+        log.debug('Published row: %s', row)
 
-        try:
-            if db_client.write_points(d):
-                print('DB updated with data: {}'.format(d))
-            else:
-                print('Failed db client data write: {}'.format(d))
-        except InfluxDBClientError as e:
-            print('Exception: {}'.format(e))
-            print('ERROR: Unable to write data to client db, data={}'.format(d))
+        if first_reading:
+            first_reading = False
+            log_startup()
 
 
 def main(skip_setup):
+    setup_logging()
     if not skip_setup:
         # Check to see if the user wants to enter config mode.
         prompt = "Do you want to enter configuration mode? (y/Y): "
@@ -0,0 +1,397 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Admin companion to rhok.py. Used to provision the influx db retention
+# policies and continuous queries (CQs) so the dashboards don't have to
+# aggregate the raw tower data at query time.
+#
+# Retention policies:
+#   <default rp>  raw 'TowerData' points, kept for --raw_days days
+#   rp_5m         5 minute rollups per tower and per group
+#   rp_1h         hourly rollups per tower and per group
+#   rp_latest     last value per tower (small, constant size)
+#
+# Continuous queries (all read the raw 'TowerData' measurement):
+#   cq_tower_5m   -> rp_5m.TowerData_tower       (mean per tower)
+#   cq_group_5m   -> rp_5m.TowerData_group       (mean per tower group)
+#   cq_tower_1h   -> rp_1h.TowerData_tower
+#   cq_group_1h   -> rp_1h.TowerData_group
+#   cq_latest     -> rp_latest.TowerData_last    (last value per tower)
+#
+# The rollup fields are prefixed by the aggregate, ie. 'mean_water_level' and
+# 'last_water_level'.
+#
+# Provisioning is idempotent, it can be re-run at any time. Only missing or
+# changed retention policies and CQs are created/updated.
+#
+# Shortening the raw data retention policy (ie. from the default 'INF' to
+# --raw_days) makes influx delete the older raw data, so it is only done with
+# --shorten_raw. It is done last, after the --backfill of the rollups (which
+# covers all the raw data in the db that is within the duration of each
+# rollup's retention policy).
+#
+##########################################################################
+# Requirements:
+# -python 3
+# -rhok.py (in this directory)
+# -an influx db user with admin privileges
+#
+##########################################################################
+# Usage:
+# Show what would be changed.
+# >>> python3 rhok_admin.py --username admin --dry_run
+#
+# Provision using a local influx db (config file with "ssl" : false).
+# >>> python3 rhok_admin.py --config local_config.json --username admin
+#
+# Backfill the rollups from all the raw data that is already in the db, then
+# only keep the last 30 days of raw data.
+# >>> python3 rhok_admin.py --username admin --backfill --shorten_raw
+#
+##########################################################################
+# Example dashboard queries (constant time, they don't touch the raw data):
+# Latest value of each tower.
+#   SELECT last(*) FROM "rp_latest"."TowerData_last" WHERE time > now() - 10m
+#       GROUP BY "towerName"
+#
+# Hourly water level of a group over the last month.
+#   SELECT "mean_water_level" FROM "rp_1h"."TowerData_group"
+#       WHERE "towerGroup" = 'Tower 60 Postal Office' AND time > now() - 30d
+##########################################################################
+
+
+import argparse
+from datetime import datetime, timedelta
+from getpass import getpass
+from influxdb.exceptions import InfluxDBClientError
+import re
+import rhok
+import sys
+
+
+DFLT_RAW_DAYS = 30
+DFLT_5M_DAYS = 180
+DFLT_1H_DAYS = 0       # 0 means keep forever.
+DFLT_LATEST_DAYS = 1
+
+RP_5M = 'rp_5m'
+RP_1H = 'rp_1h'
+RP_LATEST = 'rp_latest'
+
+TOWER_SUFFIX = '_tower'
+GROUP_SUFFIX = '_group'
+LATEST_SUFFIX = '_last'
+
+# How far back a CQ re-computes its intervals to pick up late points
+# (ie. buffered during a network outage).
+RESAMPLE_FOR_5M = '30m'
+RESAMPLE_FOR_1H = '3h'
+RESAMPLE_FOR_LATEST = '10m'
+
+LATEST_INTERVAL = '1m'
+
+CQ_LATEST = 'cq_latest'
+
+INFINITE_DURATION = 'INF'
+
+# The backfill is done one window at a time, to keep the queries small.
+BACKFILL_WINDOW_DAYS = 7
+QUERY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+SHOWN_DURATION_RE = re.compile(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?$')
+
+
+def to_duration(days):
+    """Converts a number of days to an influx retention policy duration."""
+    return '{}d'.format(days) if days else INFINITE_DURATION
+
+
+def duration_timedelta(duration):
+    """Converts a retention policy duration to a timedelta, None for
+    'INF'.
+    """
+    if INFINITE_DURATION == duration: return None
+    return timedelta(days=int(duration[:-1]))
+
+
+def to_shown_duration(duration):
+    """Converts a duration to the format returned by SHOW RETENTION POLICIES,
+    ie. '30d' -> '720h0m0s' and 'INF' -> '0s'.
+    """
+    if INFINITE_DURATION == duration: return '0s'
+    return '{}h0m0s'.format(int(duration[:-1]) * 24)
+
+
+def shown_duration_seconds(shown):
+    """Converts a duration returned by SHOW RETENTION POLICIES to seconds,
+    infinite for '0s'.
+    """
+    h, m, s = (int(v or 0) for v in SHOWN_DURATION_RE.match(shown).groups())
+    seconds = h * 3600 + m * 60 + s
+    return seconds if seconds else float('inf')
+
+
+def normalize_query(query):
+    """Used to compare a CQ to the one influx shows (it drops the quotes)."""
+    return ' '.join(query.replace('"', '').split()).lower()
+
+
+def create_retention_policies(args):
+    """Returns the retention policies as (name, duration) tuples."""
+    return [
+            (RP_5M, to_duration(args.rollup_5m_days)),
+            (RP_1H, to_duration(args.rollup_1h_days)),
+            (RP_LATEST, to_duration(args.latest_days)),
+    ]
+
+
+def create_continuous_queries(dbname, raw_rp, measurement):
+    """Returns the continuous queries as (name, target retention policy,
+    query) tuples.
+    """
+    source = '"{}"."{}"."{}"'.format(dbname, raw_rp, measurement)
+    tower_tags = '"{}", "{}"'.format(rhok.T_TOWER_NAME, rhok.T_TOWER_GROUP)
+    group_tags = '"{}"'.format(rhok.T_TOWER_GROUP)
+
+    def cq(name, resample_for, func, rp, suffix, interval, tags):
+        select = ('SELECT {}(*) INTO "{}"."{}"."{}{}" FROM {} '
+                'GROUP BY time({}), {}'.format(func, dbname, rp, measurement,
+                    suffix, source, interval, tags))
+        return (name, rp, 'CREATE CONTINUOUS QUERY "{}" ON "{}" RESAMPLE FOR '
+                '{} BEGIN {} END'.format(name, dbname, resample_for, select))
+
+    return [
+            cq('cq_tower_5m', RESAMPLE_FOR_5M,
+                'mean', RP_5M, TOWER_SUFFIX, '5m', tower_tags),
+            cq('cq_group_5m', RESAMPLE_FOR_5M,
+                'mean', RP_5M, GROUP_SUFFIX, '5m', group_tags),
+            cq('cq_tower_1h', RESAMPLE_FOR_1H,
+                'mean', RP_1H, TOWER_SUFFIX, '1h', tower_tags),
+            cq('cq_group_1h', RESAMPLE_FOR_1H,
+                'mean', RP_1H, GROUP_SUFFIX, '1h', group_tags),
+            cq(CQ_LATEST, RESAMPLE_FOR_LATEST,
+                'last', RP_LATEST, LATEST_SUFFIX, LATEST_INTERVAL,
+                tower_tags),
+    ]
+
+
+def get_default_retention_policy(retention_policies):
+    for rp in retention_policies:
+        if rp['default']: return rp
+    return None
+
+
+def provision_raw_retention_policy(client, dbname, raw_rp, raw_days,
+        shorten, dry_run):
+    """Sets the duration of the default (raw data) retention policy. It is
+    only shortened if 'shorten' is set, influx deletes the older data.
+    """
+    duration = to_duration(raw_days)
+    shown = to_shown_duration(duration)
+    if raw_rp['duration'] == shown:
+        print('Retention policy "{}" unchanged'.format(raw_rp['name']))
+        return
+
+    if (not shorten and shown_duration_seconds(shown) <
+            shown_duration_seconds(raw_rp['duration'])):
+        print('WARNING: Not shortening retention policy "{}": duration {} -> '
+                '{} deletes the older raw data, use --shorten_raw (with '
+                '--backfill to keep it in the rollups)'.format(raw_rp['name'],
+                    raw_rp['duration'], duration))
+        return
+
+    print('Altering retention policy "{}": duration {} -> {}'.format(
+        raw_rp['name'], raw_rp['duration'], duration))
+    if not dry_run:
+        client.alter_retention_policy(raw_rp['name'], database=dbname,
+                duration=duration)
+
+
+def provision_retention_policies(client, dbname, retention_policies,
+        dry_run):
+    existing = {rp['name'] : rp
+            for rp in client.get_list_retention_policies(dbname)}
+
+    for name, duration in retention_policies:
+        rp = existing.get(name)
+        if rp is None:
+            print('Creating retention policy "{}": duration {}'.format(name,
+                duration))
+            if not dry_run:
+                client.create_retention_policy(name, duration, 1,
+                        database=dbname, default=False)
+        elif rp['duration'] != to_shown_duration(duration):
+            print('Altering retention policy "{}": duration {} -> {}'.format(
+                name, rp['duration'], duration))
+            if not dry_run:
+                client.alter_retention_policy(name, database=dbname,
+                        duration=duration)
+        else:
+            print('Retention policy "{}" unchanged'.format(name))
+
+
+def get_continuous_queries(client, dbname):
+    """Returns a dict of the db's CQs, {name : query}."""
+    result = client.query('SHOW CONTINUOUS QUERIES')
+    return {cq['name'] : cq['query']
+            for cq in result.get_points(measurement=dbname)}
+
+
+def provision_continuous_queries(client, dbname, continuous_queries,
+        dry_run):
+    existing = get_continuous_queries(client, dbname)
+
+    for name, _, query in continuous_queries:
+        existing_query = existing.get(name)
+        if existing_query is not None:
+            if normalize_query(existing_query) == normalize_query(query):
+                print('Continuous query "{}" unchanged'.format(name))
+                continue
+            # A CQ can't be altered, it has to be dropped and re-created.
+            print('Dropping changed continuous query "{}"'.format(name))
+            if not dry_run:
+                client.query('DROP CONTINUOUS QUERY "{}" ON "{}"'.format(name,
+                    dbname))
+
+        print('Creating continuous query "{}"'.format(name))
+        if not dry_run: client.query(query)
+
+
+def get_first_time(client, dbname, raw_rp, measurement):
+    """Returns the time of the oldest raw point (UTC), None if there is no
+    raw data.
+    """
+    result = client.query('SELECT * FROM "{}"."{}"."{}" LIMIT 1'.format(
+        dbname, raw_rp, measurement), epoch='s')
+    points = list(result.get_points())
+    if not points: return None
+    return datetime.utcfromtimestamp(points[0]['time'])
+
+
+def backfill(client, continuous_queries, retention_policies, first_time):
+    """Runs the CQs' select statements over all the raw data in the db,
+    from 'first_time', one window at a time. Safe to re-run, the rollup
+    points are overwritten.
+
+    Each CQ starts within the duration of its target retention policy:
+    influx fails a write with points beyond it.
+    """
+    durations = dict(retention_policies)
+    step = timedelta(days=BACKFILL_WINDOW_DAYS)
+    now = datetime.utcnow()
+
+    for name, rp, query in continuous_queries:
+        # The CQ will fill this in within a minute.
+        if CQ_LATEST == name: continue
+
+        # Windows start at midnight, so they don't split the rollup
+        # intervals. The first one is rounded up to stay within the
+        # retention policy.
+        start = datetime(first_time.year, first_time.month, first_time.day)
+        duration = duration_timedelta(durations[rp])
+        if duration is not None:
+            oldest = now - duration + timedelta(days=1)
+            start = max(start, datetime(oldest.year, oldest.month,
+                oldest.day))
+
+        select = query[query.index('BEGIN') + len('BEGIN'):
+                query.rindex('END')].strip()
+        # The time range needs to go before the GROUP BY clause.
+        i = select.index('GROUP BY')
+        print('Backfilling "{}" from {}'.format(name, start.date()))
+        w_start = start
+        while w_start < now:
+            where = "WHERE time >= '{}' AND time < '{}' ".format(
+                    w_start.strftime(QUERY_TIME_FORMAT),
+                    (w_start + step).strftime(QUERY_TIME_FORMAT))
+            client.query('{}{}{}'.format(select[:i], where, select[i:]))
+            w_start += step
+
+
+def provision(client, config_data, args):
+    dbname = config_data[rhok.DB][rhok.DB_DBNAME]
+    measurement = config_data[rhok.MEASUREMENT]
+
+    raw_rp = get_default_retention_policy(
+            client.get_list_retention_policies(dbname))
+    if raw_rp is None:
+        print('ERROR: No default retention policy on db "{}"'.format(dbname))
+        return False
+
+    retention_policies = create_retention_policies(args)
+    provision_retention_policies(client, dbname, retention_policies,
+            args.dry_run)
+
+    continuous_queries = create_continuous_queries(dbname, raw_rp['name'],
+            measurement)
+    provision_continuous_queries(client, dbname, continuous_queries,
+            args.dry_run)
+
+    # Before the raw data retention policy is changed, so all the raw data
+    # is rolled up.
+    if args.backfill and not args.dry_run:
+        first_time = get_first_time(client, dbname, raw_rp['name'],
+                measurement)
+        if first_time is not None:
+            backfill(client, continuous_queries, retention_policies,
+                    first_time)
+
+    provision_raw_retention_policy(client, dbname, raw_rp, args.raw_days,
+            args.shorten_raw, args.dry_run)
+    return True
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Provision the influx db '
+            'retention policies and continuous queries.')
+    parser.add_argument('--config', default=rhok.CONFIG_FILENAME,
+            help='config file (default: %(default)s)')
+    parser.add_argument('--username', help='influx db admin username '
+            '(default: the config file username)')
+    parser.add_argument('--password', help='influx db password (prompted '
+            'for if --username is given)')
+    parser.add_argument('--raw_days', type=int, default=DFLT_RAW_DAYS,
+            help='days to keep the raw data, 0 is forever '
+            '(default: %(default)s)')
+    parser.add_argument('--rollup_5m_days', type=int, default=DFLT_5M_DAYS,
+            help='days to keep the 5 minute rollups (default: %(default)s)')
+    parser.add_argument('--rollup_1h_days', type=int, default=DFLT_1H_DAYS,
+            help='days to keep the hourly rollups (default: %(default)s)')
+    parser.add_argument('--latest_days', type=int, default=DFLT_LATEST_DAYS,
+            help='days to keep the last values (default: %(default)s)')
+    parser.add_argument('--backfill', action='store_true',
+            help='compute the rollups for the raw data already in the db')
+    parser.add_argument('--shorten_raw', action='store_true',
+            help='allow shortening the raw data retention policy to '
+            '--raw_days, the older raw data is deleted')
+    parser.add_argument('--dry_run', action='store_true',
+            help="only show what would be changed")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    config_data = rhok.get_config_data(args.config)
+    if not config_data: return 1
+
+    password = args.password
+    if password is None:
+        password = (getpass('Password: ') if args.username is not None
+                else rhok.DB_DFLT_PASSWORD)
+
+    client = rhok.config_db_client(config_data, username=args.username,
+            password=password)
+    if client is None: return 1
+
+    try:
+        if not provision(client, config_data, args): return 1
+    except InfluxDBClientError as e:
+        print('Exception: {}'.format(e))
+        print('ERROR: Unable to provision the db')
+        return 1
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
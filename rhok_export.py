@@ -0,0 +1,366 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Export of the tower history from the influx db, ie. for reports.
+#
+# The time range is split into windows (--window_hours) and each tower is
+# queried one window at a time, so memory use doesn't grow with the time
+# range. The towers are exported in parallel (--workers), each to its own
+# file in the output directory:
+#   csv      <tower>.csv.gz, one gzip member per window
+#   parquet  <tower>.<n>.parquet, one row group per window (needs pyarrow)
+#
+# Progress (the end of the last window written for each tower, and the csv
+# file size at that point) is saved in progress.json in the output directory.
+# Re-running the same export resumes where it stopped, a partially written
+# window is discarded.
+#
+##########################################################################
+# Requirements:
+# -python 3
+# -rhok.py, rhok_admin.py (in this directory)
+# -library: pyarrow (only for --format parquet)
+#
+##########################################################################
+# Usage:
+# Export a season for all the towers of a group.
+# >>> python3 rhok_export.py --group "Tower 60 Postal Office" \
+#         --start 2018-04-01 --end 2018-10-01 --output_dir export
+#
+# Export two towers from a local influx db (config file with "ssl" : false).
+# >>> python3 rhok_export.py --config local_config.json --tower Tower_60 \
+#         --tower Tower_61 --start 2018-04-01 --end 2018-05-01
+#
+# Export the hourly rollups of a tower (see rhok_admin.py), the 'mean_*'
+# fields of 'TowerData_tower'.
+# >>> python3 rhok_export.py --tower Tower_60 --rp rp_1h \
+#         --start 2018-04-01 --end 2019-04-01
+#
+##########################################################################
+
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime, timedelta
+import gzip
+from influxdb.exceptions import InfluxDBClientError
+from influxdb.resultset import ResultSet
+import json
+import os
+import re
+import rhok
+import rhok_admin
+import sys
+import threading
+
+
+FORMAT_CSV = 'csv'
+FORMAT_PARQUET = 'parquet'
+FORMATS = (FORMAT_CSV, FORMAT_PARQUET)
+
+DFLT_WINDOW_HOURS = 24
+DFLT_CHUNK_SIZE = 10000
+DFLT_WORKERS = 4
+DFLT_OUTPUT_DIR = 'export'
+
+PROGRESS_FILENAME = 'progress.json'
+P_END = 'end'
+P_SIZE = 'size'
+P_PART = 'part'
+
+TIME = 'time'
+INPUT_TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%SZ')
+QUERY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# The rollups provisioned by rhok_admin.py, exported with --rp:
+# retention policy -> (measurement suffix, field prefix). The per tower
+# rollups are exported, the per group ones have no tower name.
+ROLLUPS = {
+        rhok_admin.RP_5M : (rhok_admin.TOWER_SUFFIX, 'mean_'),
+        rhok_admin.RP_1H : (rhok_admin.TOWER_SUFFIX, 'mean_'),
+        rhok_admin.RP_LATEST : (rhok_admin.LATEST_SUFFIX, 'last_'),
+}
+
+
+def parse_time(s):
+    for fmt in INPUT_TIME_FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid time: {}'.format(s))
+
+
+def quote_str(s):
+    """Quotes a string literal for an influx query."""
+    return "'{}'".format(s.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def quote_ident(s):
+    """Quotes an identifier for an influx query."""
+    return '"{}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def safe_filename(s):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', s)
+
+
+def windows(start, end, hours):
+    """Yields the (start, end) time windows covering [start, end)."""
+    step = timedelta(hours=hours)
+    t = start
+    while t < end:
+        yield t, min(t + step, end)
+        t += step
+
+
+class Progress(object):
+    """The per tower progress, saved as json after every window."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            with open(filename) as fp:
+                self.data = json.load(fp)
+        except FileNotFoundError:
+            self.data = {}
+
+    def get(self, tower):
+        with self._lock:
+            return dict(self.data.get(tower, {}))
+
+    def update(self, tower, **kwargs):
+        with self._lock:
+            self.data.setdefault(tower, {}).update(kwargs)
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as fp:
+                json.dump(self.data, fp, indent=4)
+            os.replace(tmp_filename, self.filename)
+
+
+class CsvWriter(object):
+    """Writes a tower's windows to a gzip'ed csv, one gzip member each."""
+
+    def __init__(self, filename, columns, progress):
+        self.filename = filename
+        self.columns = columns
+        # Drop anything written after the last completed window.
+        size = progress.get(P_SIZE, 0)
+        if os.path.exists(filename):
+            with open(filename, 'r+b') as fp:
+                fp.truncate(size)
+        self._new_file = 0 == size
+
+    def write_window(self, points):
+        """Writes a window of points. Returns the progress to save."""
+        with gzip.open(self.filename, 'at', newline='') as fp:
+            writer = csv.DictWriter(fp, self.columns, extrasaction='ignore')
+            if self._new_file:
+                writer.writeheader()
+                self._new_file = False
+            writer.writerows(points)
+        return {P_SIZE : os.path.getsize(self.filename)}
+
+    def close(self):
+        pass
+
+
+class ParquetWriter(object):
+    """Writes a tower's windows to a parquet file, one row group each. A
+    resumed export starts a new part file.
+    """
+
+    def __init__(self, filename_prefix, columns, progress):
+        # Optional dependency, only needed for this format.
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+
+        self.part = progress.get(P_PART, -1) + 1
+        self.filename = '{}.{}.parquet'.format(filename_prefix, self.part)
+        self.columns = columns
+        self.schema = pyarrow.schema(
+                [(TIME, pyarrow.timestamp('ns', tz='UTC'))] +
+                [(c, pyarrow.string()) for c in columns[1:len(rhok.TAGS_ORDER)
+                    + 1]] +
+                [(c, pyarrow.float64()) for c in columns[len(rhok.TAGS_ORDER)
+                    + 1:]])
+        self._writer = None
+
+    def write_window(self, points):
+        if not points:
+            return {} if self._writer is None else {P_PART : self.part}
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(self.filename, self.schema,
+                    compression='snappy')
+        arrays = {c : [p.get(c) for p in points] for c in self.columns}
+        self._writer.write_table(self._pa.Table.from_pydict(arrays,
+            schema=self.schema))
+        return {P_PART : self.part}
+
+    def close(self):
+        # A parquet file is only readable once closed, the part only counts
+        # as done after this.
+        if self._writer is not None: self._writer.close()
+
+
+class Exporter(object):
+
+    def __init__(self, config_data, args):
+        self.config_data = config_data
+        self.args = args
+        self.measurement = args.measurement or config_data[rhok.MEASUREMENT]
+        fields = args.fields or rhok.FIELD_ORDER
+        if args.rp in ROLLUPS:
+            suffix, prefix = ROLLUPS[args.rp]
+            if not args.measurement: self.measurement += suffix
+            if not args.fields: fields = [prefix + f for f in fields]
+        self.columns = [TIME] + list(rhok.TAGS_ORDER) + list(fields)
+        self.progress = Progress(os.path.join(args.output_dir,
+            PROGRESS_FILENAME))
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        """One db client per worker thread."""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = rhok.config_db_client(self.config_data)
+            if client is None: raise InfluxDBClientError('no db client')
+            self._local.client = client
+        return client
+
+    def source(self):
+        if self.args.rp:
+            return '{}.{}'.format(quote_ident(self.args.rp),
+                    quote_ident(self.measurement))
+        return quote_ident(self.measurement)
+
+    def group_towers(self, group):
+        result = self.client.query('SHOW TAG VALUES FROM {} WITH KEY = {} '
+                'WHERE {} = {}'.format(self.source(),
+                    quote_ident(rhok.T_TOWER_NAME),
+                    quote_ident(rhok.T_TOWER_GROUP), quote_str(group)))
+        return sorted(p['value'] for p in result.get_points())
+
+    def query_window(self, tower, start, end):
+        query = ('SELECT * FROM {} WHERE {} = {} AND time >= {} AND time < {}'
+                .format(self.source(), quote_ident(rhok.T_TOWER_NAME),
+                    quote_str(tower), quote_str(start.strftime(
+                        QUERY_TIME_FORMAT)), quote_str(end.strftime(
+                        QUERY_TIME_FORMAT))))
+        epoch = 'ns' if FORMAT_PARQUET == self.args.format else None
+        result = self.client.query(query, epoch=epoch, chunked=True,
+                chunk_size=self.args.chunk_size)
+        # chunked=True returns a generator of result sets (one per chunk),
+        # or a single result set if the query failed to chunk.
+        if isinstance(result, ResultSet): result = [result]
+        for rs in result:
+            for point in rs.get_points():
+                yield point
+
+    def create_writer(self, tower, progress):
+        prefix = os.path.join(self.args.output_dir, safe_filename(tower))
+        if FORMAT_PARQUET == self.args.format:
+            return ParquetWriter(prefix, self.columns, progress)
+        return CsvWriter(prefix + '.csv.gz', self.columns, progress)
+
+    def export_tower(self, tower):
+        progress = self.progress.get(tower)
+        start = self.args.start
+        if P_END in progress:
+            start = max(start, datetime.strptime(progress[P_END],
+                QUERY_TIME_FORMAT))
+
+        writer = self.create_writer(tower, progress)
+        count = 0
+        saved = {}
+        try:
+            for w_start, w_end in windows(start, self.args.end,
+                    self.args.window_hours):
+                points = list(self.query_window(tower, w_start, w_end))
+                # Accumulated, an empty window doesn't return the part.
+                saved.update(writer.write_window(points))
+                saved[P_END] = w_end.strftime(QUERY_TIME_FORMAT)
+                count += len(points)
+                if FORMAT_CSV == self.args.format:
+                    self.progress.update(tower, **saved)
+        finally:
+            writer.close()
+            if FORMAT_PARQUET == self.args.format and saved:
+                self.progress.update(tower, **saved)
+        print('Exported tower "{}": {} points'.format(tower, count))
+        return count
+
+    def run(self, towers):
+        with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+            return sum(executor.map(self.export_tower, towers))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Export the tower history '
+            'from the influx db.')
+    parser.add_argument('--config', default=rhok.CONFIG_FILENAME,
+            help='config file (default: %(default)s)')
+    parser.add_argument('--tower', action='append', default=[],
+            help='tower name, can be repeated')
+    parser.add_argument('--group', action='append', default=[],
+            help='export all the towers of a tower group, can be repeated')
+    parser.add_argument('--start', type=parse_time, required=True,
+            help='start time (UTC), ie. 2018-04-01')
+    parser.add_argument('--end', type=parse_time, required=True,
+            help='end time (UTC, exclusive)')
+    parser.add_argument('--format', choices=FORMATS, default=FORMAT_CSV)
+    parser.add_argument('--output_dir', default=DFLT_OUTPUT_DIR)
+    parser.add_argument('--measurement',
+            help='default: the config file measurement')
+    parser.add_argument('--rp', help='retention policy, the per tower '
+            'rollups of {} (or any other with --measurement and --fields) '
+            '(default: the db default)'.format(', '.join(sorted(ROLLUPS))))
+    parser.add_argument('--fields', nargs='+',
+            help='fields to export (default: the rhok.py fields)')
+    parser.add_argument('--window_hours', type=int,
+            default=DFLT_WINDOW_HOURS)
+    parser.add_argument('--chunk_size', type=int, default=DFLT_CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=DFLT_WORKERS)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if not args.tower and not args.group:
+        print('ERROR: Nothing to export, use --tower and/or --group')
+        return 1
+    if (args.rp and args.rp not in ROLLUPS and
+            not (args.measurement and args.fields)):
+        print('ERROR: Unknown retention policy "{}", use --measurement and '
+                '--fields'.format(args.rp))
+        return 1
+
+    config_data = rhok.get_config_data(args.config)
+    if not config_data: return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    exporter = Exporter(config_data, args)
+
+    try:
+        towers = list(args.tower)
+        for group in args.group:
+            towers.extend(exporter.group_towers(group))
+        towers = sorted(set(towers))
+        count = exporter.run(towers)
+    except InfluxDBClientError as e:
+        print('Exception: {}'.format(e))
+        print('ERROR: Unable to export the tower data')
+        return 1
+
+    print('Exported {} points from {} towers to {}'.format(count, len(towers),
+        args.output_dir))
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,467 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# On-site relay. Run on one gateway pi, the rhok.py instances of the other
+# towers on the LAN write to it instead of to the influx db server.
+#
+# -Accepts influx db compatible '/write' requests (line protocol, optionally
+#  gzip'ed) and '/ping' on the LAN. Writes are acknowledged once buffered.
+# -Coalesces the lines into large batches per (db, rp, precision), sent
+#  gzip'ed to the upstream influx db (the config file 'db' section) every
+#  'batch_lines' lines or 'flush_interval' seconds.
+# -Batches that can't be sent (uplink down) are spooled to disk and re-sent,
+#  oldest first, once the uplink is back. The spool is capped at
+#  'max_spool_bytes', the oldest batches are dropped first.
+# -Batches are sent one at a time, in the order they were received, so each
+#  tower's points stay in order.
+#
+# Everything runs in a single asyncio loop, only the blocking upstream http
+# request runs in a worker thread.
+#
+##########################################################################
+# Requirements:
+# -python 3.7+
+# -rhok.py (in this directory)
+#
+##########################################################################
+# Usage:
+# On the gateway pi:
+# >>> python3 rhok_relay.py --config config.json
+#
+# On each tower pi, point the 'db' config section at the gateway:
+# "db" : {
+#     "host_name" : "192.168.1.10",
+#     "host_port" : 8086,
+#     "ssl" : false,
+#     ...
+# }
+#
+##########################################################################
+
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from daemon_logging import setup_logging
+import gzip
+import http.client
+import json
+import logging
+import os
+import rhok
+import signal
+import ssl
+import sys
+from urllib.parse import parse_qs, urlencode, urlsplit
+import zlib
+
+
+log = logging.getLogger('rhok_relay')
+
+
+# Config file keys, all optional.
+RELAY = 'relay'
+R_LISTEN_HOST = 'listen_host'
+R_LISTEN_PORT = 'listen_port'
+R_BATCH_LINES = 'batch_lines'
+R_FLUSH_INTERVAL = 'flush_interval'
+R_QUEUE_SIZE = 'queue_size'
+R_SPOOL_DIR = 'spool_dir'
+R_MAX_SPOOL_BYTES = 'max_spool_bytes'
+
+RELAY_DFLTS = {
+        R_LISTEN_HOST : '0.0.0.0',
+        R_LISTEN_PORT : 8086,
+        R_BATCH_LINES : 5000,
+        R_FLUSH_INTERVAL : 10.0,
+        R_QUEUE_SIZE : 20,              # batches kept in memory
+        R_SPOOL_DIR : 'relay_spool',
+        R_MAX_SPOOL_BYTES : 100 * 1024 * 1024,
+}
+
+UPSTREAM_TIMEOUT = 30.0
+MIN_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+STATS_INTERVAL = 300.0
+COMPRESS_LEVEL = 5
+
+MAX_BODY_BYTES = 32 * 1024 * 1024
+SPOOL_EXT = '.lp.gz'
+
+# Batch metadata keys (the /write query parameters that are passed on).
+M_DB = 'db'
+M_RP = 'rp'
+M_PRECISION = 'precision'
+META_KEYS = (M_DB, M_RP, M_PRECISION)
+
+
+class Batch(object):
+    """Gzip'ed line protocol body plus the /write parameters."""
+
+    def __init__(self, meta, body, lines):
+        self.meta = meta
+        self.body = body
+        self.lines = lines
+
+
+class Spool(object):
+    """Batches saved to disk, one file each, sent back oldest first.
+
+    File format: a json line with the metadata followed by the gzip'ed body.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.names = sorted(name for name in os.listdir(directory)
+                if name.endswith(SPOOL_EXT))
+        self.bytes = sum(os.path.getsize(self._path(name))
+                for name in self.names)
+        self._seq = int(self.names[-1].split('.')[0]) + 1 if self.names else 0
+        self.dropped_lines = 0
+        # The file being uploaded, it isn't dropped when the spool is full.
+        self.in_flight = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def put(self, batch):
+        name = '{:012d}{}'.format(self._seq, SPOOL_EXT)
+        self._seq += 1
+        header = json.dumps({'meta' : batch.meta, 'lines' : batch.lines})
+        tmp_path = self._path(name + '.tmp')
+        with open(tmp_path, 'wb') as fp:
+            fp.write(header.encode('utf-8') + b'\n')
+            fp.write(batch.body)
+        os.replace(tmp_path, self._path(name))
+        self.names.append(name)
+        self.bytes += os.path.getsize(self._path(name))
+
+        # Drop the oldest files, except the one in flight and the new one.
+        while self.bytes > self.max_bytes:
+            i = 1 if self.names[0] == self.in_flight else 0
+            if i >= len(self.names) - 1: break
+            dropped = self.read(self.names[i])
+            self.dropped_lines += dropped.lines
+            log.error('Spool full, dropped %d lines', dropped.lines)
+            self.remove(self.names[i])
+
+    def read(self, name):
+        with open(self._path(name), 'rb') as fp:
+            header = json.loads(fp.readline().decode('utf-8'))
+            return Batch(header['meta'], fp.read(), header['lines'])
+
+    def remove(self, name):
+        path = self._path(name)
+        self.names.remove(name)
+        self.bytes -= os.path.getsize(path)
+        os.remove(path)
+
+
+class Upstream(object):
+    """Blocking http client for the upstream influx db. Only used from the
+    single upload thread.
+    """
+
+    def __init__(self, config_data):
+        db = config_data[rhok.DB]
+        self.host = db[rhok.DB_HOST_NAME]
+        self.port = db[rhok.DB_HOST_PORT]
+        self.ssl = db.get(rhok.DB_SSL, True)
+        self.username = db[rhok.DB_USERNAME]
+        self.password = rhok.DB_DFLT_PASSWORD
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            if self.ssl:
+                self._conn = http.client.HTTPSConnection(self.host,
+                        self.port, timeout=UPSTREAM_TIMEOUT,
+                        context=ssl.create_default_context())
+            else:
+                self._conn = http.client.HTTPConnection(self.host, self.port,
+                        timeout=UPSTREAM_TIMEOUT)
+        return self._conn
+
+    def write(self, batch):
+        """Returns True if the batch was written."""
+        params = {key : value for key, value in batch.meta.items() if value}
+        params['u'] = self.username
+        params['p'] = self.password
+        try:
+            conn = self._connection()
+            conn.request('POST', '/write?' + urlencode(params), batch.body, {
+                'Content-Type' : 'application/octet-stream',
+                'Content-Encoding' : 'gzip',
+            })
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            log.warning('Upstream write failed: %s', e)
+            self.close()
+            return False
+
+        if 204 == response.status: return True
+        log.warning('Upstream write failed: %d %s', response.status,
+                body[:200])
+        if 400 == response.status:
+            # Bad data won't get better by retrying, don't block the queue.
+            log.error('Upstream rejected %d lines, dropped', batch.lines)
+            return True
+        return False
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class Relay(object):
+
+    def __init__(self, config_data, relay_config, loop):
+        self.loop = loop
+        self.batch_lines = relay_config[R_BATCH_LINES]
+        self.flush_interval = relay_config[R_FLUSH_INTERVAL]
+        self.upstream = Upstream(config_data)
+        self.spool = Spool(relay_config[R_SPOOL_DIR],
+                relay_config[R_MAX_SPOOL_BYTES])
+        self.queue = asyncio.Queue(relay_config[R_QUEUE_SIZE])
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # Open batches, (db, rp, precision) -> list of lines.
+        self.pending = {}
+        self.pending_lines = 0
+
+        # The batch taken off the queue that is being uploaded.
+        self.uploading = None
+
+        self.received = 0
+        self.sent = 0
+        self.requests = 0
+
+    #
+    # Batching.
+    #
+    def add_lines(self, meta, lines):
+        key = tuple(meta.get(k) for k in META_KEYS)
+        self.pending.setdefault(key, []).extend(lines)
+        self.pending_lines += len(lines)
+        self.received += len(lines)
+        if len(self.pending[key]) >= self.batch_lines: self.seal(key)
+
+    def seal(self, key):
+        lines = self.pending.pop(key, None)
+        if not lines: return
+        self.pending_lines -= len(lines)
+        body = gzip.compress(b'\n'.join(lines), COMPRESS_LEVEL)
+        self.submit(Batch(dict(zip(META_KEYS, key)), body, len(lines)))
+
+    def seal_all(self):
+        for key in list(self.pending): self.seal(key)
+
+    def submit(self, batch):
+        # Once something is spooled, everything after it has to go through
+        # the spool too, to keep the order.
+        if len(self.spool) or self.queue.full():
+            self.spill_queue()
+            self.spool.put(batch)
+        else:
+            self.queue.put_nowait(batch)
+
+    def spill_queue(self):
+        while not self.queue.empty():
+            self.spool.put(self.queue.get_nowait())
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.seal_all()
+
+    #
+    # Upload.
+    #
+    async def upload(self, batch):
+        return await self.loop.run_in_executor(self.executor,
+                self.upstream.write, batch)
+
+    async def upload_loop(self):
+        delay = MIN_RETRY_DELAY
+        while True:
+            if len(self.spool):
+                # Removed by name, older files may be dropped meanwhile.
+                name = self.spool.names[0]
+                batch = self.spool.read(name)
+                self.spool.in_flight = name
+                try:
+                    ok = await self.upload(batch)
+                finally:
+                    self.spool.in_flight = None
+                if ok:
+                    self.spool.remove(name)
+                    self.sent += batch.lines
+                    delay = MIN_RETRY_DELAY
+                else:
+                    await asyncio.sleep(delay)
+                    delay = min(MAX_RETRY_DELAY, delay * 2)
+                continue
+
+            batch = await self.queue.get()
+            self.uploading = batch
+            try:
+                ok = await self.upload(batch)
+            finally:
+                self.uploading = None
+            if ok:
+                self.sent += batch.lines
+            else:
+                self.spool.put(batch)
+                self.spill_queue()
+                log.warning('Uplink down, spooling to disk')
+                await asyncio.sleep(delay)
+                delay = min(MAX_RETRY_DELAY, delay * 2)
+
+    async def stats_loop(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            log.info('Relay stats', extra={'fields' : {
+                'requests' : self.requests,
+                'received' : self.received,
+                'sent' : self.sent,
+                'pending' : self.pending_lines,
+                'queued' : self.queue.qsize(),
+                'spooled' : len(self.spool),
+                'spool_bytes' : self.spool.bytes,
+                'spool_dropped' : self.spool.dropped_lines,
+            }})
+
+    #
+    # Http server.
+    #
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                keep_alive = await self.handle_request(reader, writer)
+                if not keep_alive: break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            log.warning('Bad request: %s', e)
+            self.respond(writer, 400, 'Bad Request')
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer):
+        request_line = await reader.readline()
+        if not request_line: return False
+        method, target, version = request_line.decode('latin-1').split()
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''): break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_BYTES: raise ValueError('body too large')
+        body = await reader.readexactly(length) if length else b''
+
+        keep_alive = ('close' != headers.get('connection', '').lower() and
+                'HTTP/1.0' != version)
+        url = urlsplit(target)
+
+        if '/ping' == url.path:
+            self.respond(writer, 204, 'No Content')
+        elif '/write' == url.path and 'POST' == method:
+            if 'gzip' == headers.get('content-encoding'):
+                try:
+                    body = gzip.decompress(body)
+                except (OSError, EOFError, zlib.error) as e:
+                    raise ValueError('invalid gzip body ({})'.format(e))
+            params = parse_qs(url.query)
+            meta = {key : params[key][0] for key in META_KEYS if key in params}
+            if M_DB not in meta:
+                self.respond(writer, 400, 'Bad Request')
+            else:
+                self.requests += 1
+                self.add_lines(meta, [line for line in body.split(b'\n')
+                    if line.strip()])
+                self.respond(writer, 204, 'No Content')
+        else:
+            self.respond(writer, 404, 'Not Found')
+
+        await writer.drain()
+        return keep_alive
+
+    def respond(self, writer, status, reason):
+        writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\n'
+                'X-Influxdb-Version: relay\r\n\r\n'.format(status,
+                    reason).encode('latin-1'))
+
+    def start(self, host, port):
+        server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle_client, host, port))
+        for coro in (self.flush_loop(), self.upload_loop(),
+                self.stats_loop()):
+            asyncio.ensure_future(coro)
+        log.info('Relay listening on %s:%s, upstream %s:%s', host, port,
+                self.upstream.host, self.upstream.port)
+        return server
+
+    def stop(self):
+        """Spools whatever wasn't sent, so it is sent on the next start. A
+        batch that was being uploaded is spooled too, it may be written
+        twice (influx overwrites the identical points).
+        """
+        if self.uploading is not None: self.spool.put(self.uploading)
+        self.seal_all()
+        self.spill_queue()
+        self.executor.shutdown()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='On-site influx db write '
+            'relay.')
+    parser.add_argument('--config', default=rhok.CONFIG_FILENAME,
+            help='config file (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    setup_logging()
+
+    config_data = rhok.get_config_data(args.config)
+    if not config_data: return 1
+    relay_config = dict(RELAY_DFLTS)
+    relay_config.update(config_data.get(RELAY, {}))
+
+    loop = asyncio.get_event_loop()
+    relay = Relay(config_data, relay_config, loop)
+    server = relay.start(relay_config[R_LISTEN_HOST],
+            relay_config[R_LISTEN_PORT])
+    # systemctl stop/restart, the lines already acknowledged are spooled.
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        relay.stop()
+        # Finish the remaining tasks before the loop is closed (they crash
+        # the interpreter if they're garbage collected at exit).
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks: task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks,
+            return_exceptions=True))
+        loop.close()
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,290 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Shared memory snapshot of the latest sensor readings. The acquisition
+# process (rhok.py, RaspberryPiZeroCode/Test2.py) publishes each converted
+# reading to a memory mapped file in /dev/shm, any number of local readers
+# (LCD, LEDs, the cli below, metrics) read it without locks and without
+# talking to the arduino.
+#
+# Layout (little endian, fixed for the life of the file):
+#   header   64 bytes   magic, version, field count, history length, name
+#                       size, seq (8 bytes, offset 24), count (8 bytes,
+#                       offset 32)
+#   names    NAME_SIZE bytes per field, utf-8, zero padded
+#   slots    'history' slots: time (double, unix seconds) then one double
+#            per field (NaN: no value). Reading n (from 0) is in slot
+#            n % history, the latest is count - 1.
+#
+# Seqlock: the writer makes 'seq' odd, updates the slot and the count, then
+# makes 'seq' even again. A reader copies what it needs between two reads
+# of 'seq' and retries if 'seq' was odd or changed, so it always gets a
+# consistent reading. There must be only one writer per file.
+#
+# Note: Keep this file python 2 and 3 compatible, so it can also be used by
+# the python 2 code on the pi zero.
+#
+##########################################################################
+# Usage:
+# Show the latest reading published by rhok.py, every 5 seconds.
+# >>> python3 shm_snapshot.py /dev/shm/rhok_snapshot --watch 5
+#
+# >>> reader = SnapshotReader('/dev/shm/rhok_snapshot')
+# >>> reading = reader.latest()
+# >>> reading.values['pH']
+#
+##########################################################################
+
+
+import argparse
+from collections import namedtuple
+from datetime import datetime
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+
+MAGIC = b'GFSNAP01'
+VERSION = 1
+NAME_SIZE = 32
+DFLT_HISTORY = 60
+
+HEADER = struct.Struct('<8sIIIIQQ')
+HEADER_SIZE = 64
+SEQ = struct.Struct('<Q')
+SEQ_OFFSET = 24
+COUNT_OFFSET = 32
+
+# A reader spins this many times, then yields to the writer between
+# attempts. A writer killed mid-update leaves 'seq' odd, the reader gives up.
+READ_SPINS = 100
+MAX_READ_ATTEMPTS = 1000
+
+
+Reading = namedtuple('Reading', 'count time values')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def to_double(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def slots_offset(n_fields):
+    return HEADER_SIZE + n_fields * NAME_SIZE
+
+
+def file_size(n_fields, history):
+    return slots_offset(n_fields) + history * (n_fields + 1) * 8
+
+
+class SnapshotWriter(object):
+    """Publishes the readings to the snapshot file 'path'. An existing file
+    with the same fields and history is reused (the readers keep their
+    mapping), otherwise it is replaced.
+    """
+
+    def __init__(self, path, fields, history=DFLT_HISTORY):
+        self.path = path
+        self.fields = tuple(fields)
+        self.history = history
+        self._slot = struct.Struct('<{}d'.format(len(self.fields) + 1))
+        self._slots_offset = slots_offset(len(self.fields))
+        self._size = file_size(len(self.fields), history)
+
+        self._fp = self._open()
+        self._map = mmap.mmap(self._fp.fileno(), self._size)
+        seq, = SEQ.unpack_from(self._map, SEQ_OFFSET)
+        self.count, = SEQ.unpack_from(self._map, COUNT_OFFSET)
+        # Even, in case the previous writer died mid-update.
+        self.seq = seq + seq % 2
+        SEQ.pack_into(self._map, SEQ_OFFSET, self.seq)
+
+    def _header(self):
+        return HEADER.pack(MAGIC, VERSION, len(self.fields), self.history,
+                NAME_SIZE, 0, 0) + b'\0' * (HEADER_SIZE - HEADER.size)
+
+    def _names(self):
+        return b''.join(name.encode('utf-8')[:NAME_SIZE].ljust(NAME_SIZE,
+            b'\0') for name in self.fields)
+
+    def _open(self):
+        try:
+            fp = open(self.path, 'r+b')
+            layout = fp.read(self._slots_offset)
+            if (os.fstat(fp.fileno()).st_size == self._size and
+                    layout[:SEQ_OFFSET] == self._header()[:SEQ_OFFSET] and
+                    layout[HEADER_SIZE:] == self._names()):
+                return fp
+            fp.close()
+        except (IOError, OSError):
+            pass
+
+        # Written in full then renamed, so a reader never sees a partial
+        # header.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(self._header() + self._names())
+            fp.write(b'\0' * (self._size - self._slots_offset))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, self.path)
+        return open(self.path, 'r+b')
+
+    def publish(self, values, t=None):
+        """Publishes a reading, 'values' maps the field names to numbers. The
+        missing or non numeric values are published as NaN.
+        """
+        if t is None: t = time.time()
+        slot = [t] + [to_double(values.get(name)) for name in self.fields]
+        offset = self._slots_offset + (self.count % self.history) * \
+                self._slot.size
+
+        SEQ.pack_into(self._map, SEQ_OFFSET, self.seq + 1)
+        self._slot.pack_into(self._map, offset, *slot)
+        SEQ.pack_into(self._map, COUNT_OFFSET, self.count + 1)
+        SEQ.pack_into(self._map, SEQ_OFFSET, self.seq + 2)
+        self.seq += 2
+        self.count += 1
+
+    def close(self):
+        self._map.close()
+        self._fp.close()
+
+
+class SnapshotReader(object):
+    """Reads the snapshot file 'path', lock free."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._fp.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fp.close()
+            raise SnapshotError('empty snapshot file: {}'.format(path))
+        self._inode = os.fstat(self._fp.fileno()).st_ino
+
+        magic, version, n_fields, self.history, name_size, _, _ = \
+                HEADER.unpack_from(self._map, 0)
+        if MAGIC != magic or VERSION != version or NAME_SIZE != name_size:
+            self.close()
+            raise SnapshotError('not a snapshot file: {}'.format(path))
+        self.fields = tuple(self._map[HEADER_SIZE + i * NAME_SIZE:
+            HEADER_SIZE + (i + 1) * NAME_SIZE].rstrip(b'\0').decode('utf-8')
+            for i in range(n_fields))
+        self._slot = struct.Struct('<{}d'.format(n_fields + 1))
+        self._slots_offset = slots_offset(n_fields)
+
+    def _read(self, func):
+        """Calls func() until it ran without a concurrent update."""
+        for attempt in range(MAX_READ_ATTEMPTS):
+            seq, = SEQ.unpack_from(self._map, SEQ_OFFSET)
+            if 0 == seq % 2:
+                result = func()
+                if SEQ.unpack_from(self._map, SEQ_OFFSET)[0] == seq:
+                    return result
+            if attempt >= READ_SPINS: time.sleep(0.001)
+        raise SnapshotError('snapshot update not finished: {}'.format(
+            self.path))
+
+    def _count(self):
+        return SEQ.unpack_from(self._map, COUNT_OFFSET)[0]
+
+    def _reading(self, n):
+        slot = self._slot.unpack_from(self._map, self._slots_offset +
+                (n % self.history) * self._slot.size)
+        return n + 1, slot
+
+    def _to_reading(self, raw):
+        count, slot = raw
+        return Reading(count, slot[0], dict((name, None if math.isnan(v)
+            else v) for name, v in zip(self.fields, slot[1:])))
+
+    def latest(self):
+        """Returns the latest Reading, None if nothing was published."""
+        def read():
+            count = self._count()
+            return self._reading(count - 1) if count else None
+        raw = self._read(read)
+        return None if raw is None else self._to_reading(raw)
+
+    def readings(self):
+        """Returns the readings in the history, oldest first."""
+        def read():
+            count = self._count()
+            return [self._reading(n) for n in range(max(0,
+                count - self.history), count)]
+        return [self._to_reading(raw) for raw in self._read(read)]
+
+    def replaced(self):
+        """True if the writer replaced the file (ie. new fields), a new
+        reader is needed to see the new readings.
+        """
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return True
+
+    def close(self):
+        self._map.close()
+        self._fp.close()
+
+
+def format_reading(reading):
+    t = datetime.utcfromtimestamp(reading.time).isoformat() + 'Z'
+    return '{} #{} {}'.format(t, reading.count, ' '.join('{}={}'.format(
+        name, '' if v is None else v) for name, v in
+        sorted(reading.values.items())))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Show the readings of a '
+            'shared memory snapshot.')
+    parser.add_argument('path')
+    parser.add_argument('--history', action='store_true',
+            help='show all the readings in the history')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+            help='show the latest reading every SECONDS')
+    args = parser.parse_args(argv)
+
+    try:
+        reader = SnapshotReader(args.path)
+        if args.history:
+            for reading in reader.readings(): print(format_reading(reading))
+            return 0
+
+        count = None
+        while True:
+            reading = reader.latest()
+            if reading is None:
+                if count is None: print('No readings')
+                count = 0
+            elif reading.count != count:
+                print(format_reading(reading))
+                count = reading.count
+            if not args.watch: break
+            sys.stdout.flush()
+            time.sleep(args.watch)
+            if reader.replaced():
+                reader.close()
+                reader = SnapshotReader(args.path)
+    except (IOError, OSError, SnapshotError) as e:
+        print('ERROR: {}'.format(e))
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,479 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Output sinks for the sensor data read by rhok.sensor_loop.
+#
+# Each reading is converted once into a read only row (see freeze_row) which
+# is shared by all the sinks. Every sink runs behind its own SinkWorker: a
+# bounded queue and a thread that writes the rows in batches, retries failed
+# batches and counts the dropped rows. A slow or broken sink never blocks the
+# serial loop or the other sinks, once its queue is full new rows for that
+# sink are dropped (and counted).
+#
+# A worker can also have a CircuitBreaker (used for the db sinks). After
+# 'failure_threshold' failed writes in a row the breaker opens: no writes are
+# attempted, so the worker doesn't wait out a connection timeout for every
+# batch, and the rows are set aside in a bounded backlog. After a jittered,
+# exponentially growing delay one batch is written as a probe (half open), if
+# it succeeds the breaker closes and the backlog is written, oldest first.
+#
+# Adding a sink:
+#   -subclass Sink and implement write(rows), optionally open() and close()
+#   -raise SinkError (or let an OSError through) when a batch can't be written
+#    now, RejectedError when it can never be written (ie. bad data), the
+#    batch is then dropped instead of retried
+#   -rows must be treated as read only, they are shared with the other sinks
+#
+##########################################################################
+# Usage:
+# >>> fan_out = FanOut([SinkWorker(CsvSink('data.csv', tag_keys,
+# ...         field_keys))])
+# >>> fan_out.start()
+# >>> fan_out.publish(freeze_row(point))
+# >>> fan_out.stop()
+#
+##########################################################################
+
+
+from collections import deque
+import csv
+from datetime import datetime
+import json
+from log_sink import LogSink
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from types import MappingProxyType
+
+
+log = logging.getLogger('sinks')
+
+
+MEASUREMENT = 'measurement'
+TAGS = 'tags'
+FIELDS = 'fields'
+TIME = 'time'
+
+NS_PER_SECOND = 1000000000
+
+DFLT_QUEUE_SIZE = 1000
+DFLT_BATCH_SIZE = 50
+DFLT_MAX_RETRIES = 3
+DFLT_RETRY_DELAY = 2.0    # seconds, doubled after each failed attempt
+
+# How long a worker waits for rows before checking if it should stop.
+WORKER_POLL_INTERVAL = 0.5
+MAX_OPEN_RETRY_DELAY = 300.0
+
+DFLT_BACKLOG_SIZE = 10000     # rows set aside while the breaker is open
+DFLT_FAILURE_THRESHOLD = 3
+DFLT_RESET_TIMEOUT = 10.0     # seconds, doubled each time the probe fails
+DFLT_MAX_RESET_TIMEOUT = 600.0
+DFLT_JITTER = 0.2             # fraction of the reset timeout
+
+# Circuit breaker states.
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class SinkError(Exception):
+    pass
+
+
+class RejectedError(SinkError):
+    """The sink rejected the batch, writing it again won't help."""
+    pass
+
+
+def now_ns():
+    return int(time.time() * NS_PER_SECOND)
+
+
+def freeze_row(point):
+    """Returns a read only copy of an influx db point (dict with measurement,
+    tags, fields and time), used to share it between the sinks.
+    """
+    row = dict(point)
+    row[TAGS] = MappingProxyType(dict(point[TAGS]))
+    row[FIELDS] = MappingProxyType(dict(point[FIELDS]))
+    return MappingProxyType(row)
+
+
+def thaw_row(row):
+    """Returns a plain dict copy of a row, ie. for json."""
+    d = dict(row)
+    d[TAGS] = dict(row[TAGS])
+    d[FIELDS] = dict(row[FIELDS])
+    return d
+
+
+def row_time_str(row):
+    """Returns the row time as an ISO 8601 UTC string."""
+    t = datetime.utcfromtimestamp(row[TIME] / NS_PER_SECOND)
+    return t.isoformat() + 'Z'
+
+
+class CircuitBreaker(object):
+    """Stops the writes to a failing sink for a while, see the module
+    notes. Used from the sink's worker thread only.
+    """
+
+    def __init__(self, name, failure_threshold=DFLT_FAILURE_THRESHOLD,
+            reset_timeout=DFLT_RESET_TIMEOUT,
+            max_reset_timeout=DFLT_MAX_RESET_TIMEOUT, jitter=DFLT_JITTER,
+            clock=time.time):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.jitter = jitter
+        self.clock = clock
+
+        self.state = CLOSED
+        self.failures = 0       # In a row.
+        self.opened = 0         # In a row, without a successful probe.
+        self.trips = 0
+        self.retry_at = 0.0
+
+    def allow(self):
+        """Returns True if a write can be attempted. Once the reset timeout
+        is over, the next write is the half open probe.
+        """
+        if CLOSED == self.state: return True
+        if OPEN == self.state and self.clock() >= self.retry_at:
+            self._transition(HALF_OPEN)
+            return True
+        return False
+
+    def success(self):
+        if CLOSED != self.state: self._transition(CLOSED)
+        self.failures = 0
+        self.opened = 0
+
+    def failure(self, error):
+        self.failures += 1
+        if (HALF_OPEN == self.state or
+                self.failures >= self.failure_threshold):
+            self._open(error)
+
+    def stats(self):
+        return {'state' : self.state, 'trips' : self.trips}
+
+    def _open(self, error):
+        timeout = min(self.max_reset_timeout,
+                self.reset_timeout * 2 ** self.opened)
+        timeout *= 1.0 + random.uniform(-self.jitter, self.jitter)
+        self.opened += 1
+        self.trips += 1
+        self.retry_at = self.clock() + timeout
+        self._transition(OPEN, retry_in=round(timeout, 1),
+                failures=self.failures, error=str(error))
+
+    def _transition(self, state, **fields):
+        level = logging.WARNING if OPEN == state else logging.INFO
+        log.log(level, 'Circuit breaker of sink "%s": %s -> %s', self.name,
+                self.state, state, extra={'fields' : fields})
+        self.state = state
+
+
+class Sink(object):
+    """Base class of the output sinks. All the methods are called from the
+    sink's worker thread.
+    """
+    name = 'sink'
+
+    def open(self):
+        pass
+
+    def write(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InfluxSink(Sink):
+    """Writes the rows to an influx db. 'connect' returns the db client (or
+    None), it is called from the worker thread so a slow import/connection
+    doesn't hold up the caller.
+    """
+
+    def __init__(self, name, connect):
+        self.name = name
+        self.connect = connect
+        self.client = None
+
+    def open(self):
+        self.client = self.connect()
+        if self.client is None: raise SinkError('no db client')
+
+    def write(self, rows):
+        # Imported here, the influx db exceptions are only needed if this sink
+        # is used.
+        from influxdb.exceptions import (InfluxDBClientError,
+                InfluxDBServerError)
+        try:
+            ok = self.client.write_points(rows)
+        except InfluxDBClientError as e:
+            # 4xx: bad data (no fields, field type conflict, beyond the
+            # retention policy...), the db is fine.
+            if e.code is not None and 400 <= e.code < 500:
+                raise RejectedError(e)
+            raise SinkError(e)
+        except InfluxDBServerError as e:
+            raise SinkError(e)
+        if not ok: raise SinkError('write_points failed')
+
+
+class CsvSink(Sink):
+    """Appends the rows to a csv file, one column per tag/field."""
+
+    def __init__(self, filename, tag_keys, field_keys, name='csv'):
+        self.name = name
+        self.filename = filename
+        self.tag_keys = tag_keys
+        self.field_keys = field_keys
+        self._fp = None
+        self._writer = None
+
+    def open(self):
+        new_file = (not os.path.exists(self.filename) or
+                0 == os.path.getsize(self.filename))
+        self._fp = open(self.filename, 'a', newline='')
+        self._writer = csv.writer(self._fp)
+        if new_file:
+            self._writer.writerow((TIME, MEASUREMENT) + tuple(self.tag_keys) +
+                    tuple(self.field_keys))
+
+    def write(self, rows):
+        for row in rows:
+            tags = row[TAGS]
+            fields = row[FIELDS]
+            self._writer.writerow([row_time_str(row), row[MEASUREMENT]] +
+                    [tags.get(key, '') for key in self.tag_keys] +
+                    [fields.get(key, '') for key in self.field_keys])
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None: self._fp.close()
+
+
+class HistorySink(Sink):
+    """Keeps a local history of the rows as json lines, in a rotating
+    LogSink.
+    """
+
+    def __init__(self, filename, name='history', **log_sink_kwargs):
+        self.name = name
+        self.filename = filename
+        self.log_sink_kwargs = log_sink_kwargs
+        self._log = None
+
+    def open(self):
+        self._log = LogSink(self.filename, **self.log_sink_kwargs)
+
+    def write(self, rows):
+        for row in rows:
+            self._log.write(json.dumps(thaw_row(row)))
+
+    def close(self):
+        if self._log is not None: self._log.close()
+
+
+class SinkWorker(object):
+    """Feeds a sink from a bounded queue, in batches, on its own thread.
+
+    With a 'breaker' the failed batches aren't retried after 'retry_delay'
+    (max_retries is not used), they are set aside in the backlog until the
+    breaker lets them through. Once the backlog is full the oldest rows are
+    dropped. A batch the sink rejects (RejectedError) is never retried, it
+    is dropped and counted as failed.
+    """
+
+    def __init__(self, sink, queue_size=DFLT_QUEUE_SIZE,
+            batch_size=DFLT_BATCH_SIZE, max_retries=DFLT_MAX_RETRIES,
+            retry_delay=DFLT_RETRY_DELAY, breaker=None,
+            backlog_size=DFLT_BACKLOG_SIZE):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.breaker = breaker
+        self.backlog_size = backlog_size
+
+        self.written = 0
+        self.dropped = 0        # Queue full.
+        self.failed = 0         # Gave up after max_retries, or rejected.
+        self.failed_batches = 0
+        self.backlog_dropped = 0
+
+        self._backlog = deque()
+        self._queue = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                name='sink-{}'.format(sink.name))
+        self._thread.daemon = True
+
+    @property
+    def name(self):
+        return self.sink.name
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, row):
+        """Queue a row, never blocks. The row is dropped if the queue is
+        full.
+        """
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            log.warning('Sink "%s" queue full, row dropped', self.name,
+                    extra={'fields' : {'dropped' : self.dropped}})
+
+    def stop(self, timeout=None):
+        """Stops the worker once its queue is empty."""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        stats = {
+                'queued' : self._queue.qsize(),
+                'written' : self.written,
+                'dropped' : self.dropped,
+                'failed' : self.failed,
+                'failed_batches' : self.failed_batches,
+        }
+        if self.breaker is not None:
+            stats.update(self.breaker.stats())
+            stats['backlog'] = len(self._backlog)
+            stats['backlog_dropped'] = self.backlog_dropped
+        return stats
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=WORKER_POLL_INTERVAL)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sink.write(batch)
+                self.written += len(batch)
+                return True
+            except RejectedError as e:
+                self._reject(batch, e)
+                return False
+            except (SinkError, OSError) as e:
+                log.warning('Unable to write %d rows to sink "%s" (attempt '
+                        '%d/%d): %s', len(batch), self.name, attempt + 1,
+                        self.max_retries + 1, e)
+            if attempt < self.max_retries:
+                if self._stop.wait(delay): break
+                delay *= 2
+
+        self.failed += len(batch)
+        self.failed_batches += 1
+        log.error('Gave up writing %d rows to sink "%s"', len(batch),
+                self.name)
+        return False
+
+    def _reject(self, batch, error):
+        self.failed += len(batch)
+        self.failed_batches += 1
+        log.error('Sink "%s" rejected %d rows, dropped: %s', self.name,
+                len(batch), error)
+
+    def _set_aside(self, batch):
+        self._backlog.extend(batch)
+        overflow = len(self._backlog) - self.backlog_size
+        if overflow > 0:
+            for _ in range(overflow): self._backlog.popleft()
+            self.backlog_dropped += overflow
+            log.warning('Sink "%s" backlog full, %d oldest rows dropped',
+                    self.name, overflow,
+                    extra={'fields' : {'dropped' : self.backlog_dropped}})
+
+    def _write_backlog(self):
+        """Writes the backlog, oldest first, while the breaker allows it."""
+        while self._backlog and self.breaker.allow():
+            batch = [self._backlog.popleft()
+                    for _ in range(min(self.batch_size, len(self._backlog)))]
+            try:
+                self.sink.write(batch)
+                self.written += len(batch)
+            except RejectedError as e:
+                # The sink answered, only the batch is bad.
+                self._reject(batch, e)
+            except (SinkError, OSError) as e:
+                log.warning('Unable to write %d rows to sink "%s": %s',
+                        len(batch), self.name, e)
+                self._backlog.extendleft(reversed(batch))
+                self.breaker.failure(e)
+                return
+            self.breaker.success()
+
+    def _open(self):
+        """Opens the sink, retrying until it opens or the worker is stopped.
+        Rows are queued in the meantime.
+        """
+        delay = self.retry_delay
+        while True:
+            try:
+                self.sink.open()
+                return True
+            except (SinkError, OSError) as e:
+                log.error('Unable to open sink "%s" (retry in %.0fs): %s',
+                        self.name, delay, e)
+            if self._stop.wait(delay): return False
+            delay = min(MAX_OPEN_RETRY_DELAY, delay * 2)
+
+    def _run(self):
+        if not self._open(): return
+
+        try:
+            while not (self._stop.is_set() and self._queue.empty()):
+                batch = self._next_batch()
+                if self.breaker is None:
+                    if batch: self._write(batch)
+                else:
+                    # Even when closed, so the rows stay in order.
+                    if batch: self._set_aside(batch)
+                    self._write_backlog()
+        finally:
+            if self._backlog:
+                log.error('Sink "%s" stopped, %d rows not written',
+                        self.name, len(self._backlog))
+            self.sink.close()
+
+
+class FanOut(object):
+    """Publishes each row to all the sink workers."""
+
+    def __init__(self, workers):
+        self.workers = list(workers)
+
+    def start(self):
+        for worker in self.workers: worker.start()
+
+    def publish(self, row):
+        for worker in self.workers: worker.put(row)
+
+    def stop(self, timeout=None):
+        for worker in self.workers: worker.stop(timeout)
+
+    def stats(self):
+        return {worker.name : worker.stats() for worker in self.workers}
@@ -0,0 +1,119 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Startup benchmark for rhok.py. Starts 'rhok.py --skip_setup' a number of
+# times against a virtual arduino (arduino_emulator.py) that sends sensor data
+# lines on a pseudo terminal and reports:
+#   -first reading: time from process start to the first published reading,
+#    measured from outside the process
+#   -startup_ms/max_rss_kb: as logged by rhok.py ('First reading')
+#
+# The db points at a closed local port, the readings are queued by the db
+# sink, so the benchmark doesn't depend on the network. The snapshot is
+# published in the temporary directory, not to the one of a running rhok.py.
+#
+##########################################################################
+# Requirements:
+# -python 3, linux (pty)
+# -arduino_emulator.py (in this directory)
+# -the rhok.py requirements
+#
+##########################################################################
+# Usage:
+# >>> python3 startup_bench.py --runs 5
+#
+##########################################################################
+
+
+import argparse
+from arduino_emulator import SerialEmulator, synthetic_lines
+import json
+import os
+import re
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+RHOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rhok.py')
+DFLT_CONFIG = os.path.join(os.path.dirname(RHOK), 'default_config.json')
+
+LINE_RATE = 20.0
+TIMEOUT = 60.0
+
+FIRST_READING_RE = re.compile(
+        r'msg="First reading".*max_rss_kb=(\d+).*startup_ms=(\d+)')
+
+
+def create_config(directory, serial_port):
+    with open(DFLT_CONFIG) as fp:
+        config_data = json.load(fp)
+    config_data['arduino']['serial_port'] = serial_port
+    config_data['db']['host_name'] = '127.0.0.1'
+    config_data['db']['host_port'] = 9    # discard, nothing listens
+    config_data['db']['ssl'] = False
+    # Not the live daemon's snapshot, there must be only one writer.
+    config_data['snapshot']['path'] = os.path.join(directory, 'snapshot')
+    with open(os.path.join(directory, 'config.json'), 'w') as fp:
+        json.dump(config_data, fp)
+
+
+def run_once(directory):
+    """Returns (first reading secs, startup_ms, max_rss_kb)."""
+    start = time.time()
+    process = subprocess.Popen([sys.executable, RHOK, '--skip_setup'],
+            cwd=directory, stderr=subprocess.PIPE)
+    try:
+        output = b''
+        while time.time() - start < TIMEOUT:
+            ready, _, _ = select.select([process.stderr], [], [], 1.0)
+            if not ready: continue
+            chunk = os.read(process.stderr.fileno(), 4096)
+            if not chunk: break
+            output += chunk
+            match = FIRST_READING_RE.search(output.decode('utf-8', 'replace'))
+            if match:
+                return (time.time() - start, int(match.group(2)),
+                        int(match.group(1)))
+        raise RuntimeError('no first reading, output:\n{}'.format(
+            output.decode('utf-8', 'replace')))
+    finally:
+        process.kill()
+        process.wait()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='rhok.py startup benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    emulator = SerialEmulator(synthetic_lines(LINE_RATE, 0.0))
+    emulator.start()
+
+    directory = tempfile.mkdtemp(prefix='rhok-bench-')
+    try:
+        create_config(directory, emulator.port)
+        results = [run_once(directory) for _ in range(args.runs)]
+    finally:
+        emulator.close()
+        shutil.rmtree(directory)
+
+    for i, (first, startup_ms, rss) in enumerate(results):
+        print('run {}: first reading {:.0f} ms (in process {} ms), max rss '
+                '{} kB'.format(i + 1, first * 1000, startup_ms, rss))
+    print('median: first reading {:.0f} ms, max rss {} kB'.format(
+        median([r[0] for r in results]) * 1000,
+        median([r[2] for r in results])))
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main(sys.argv[1:]))
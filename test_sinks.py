@@ -0,0 +1,161 @@
+##########################################################################
+# Growing Futures Hydroponic Monitoring System
+#
+# Tests of the sink workers' circuit breaker.
+#
+##########################################################################
+# Usage:
+# >>> python3 -m unittest test_sinks
+#
+##########################################################################
+
+
+import unittest
+
+from sinks import (CLOSED, FIELDS, HALF_OPEN, OPEN, CircuitBreaker,
+        InfluxSink, RejectedError, Sink, SinkError, SinkWorker)
+
+try:
+    from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+except ImportError:
+    InfluxDBClientError = None
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSink(Sink):
+    """Fails while 'down', rejects the batches with a row without fields."""
+    name = 'fake'
+
+    def __init__(self):
+        self.down = False
+        self.rows = []
+        self.breaker = None
+        self.states = []    # Of the breaker, at each write.
+
+    def write(self, rows):
+        if self.breaker is not None: self.states.append(self.breaker.state)
+        if self.down: raise SinkError('connection refused')
+        if any(not row[FIELDS] for row in rows):
+            raise RejectedError('400: no fields')
+        self.rows.extend(rows)
+
+
+def row(n, fields=True):
+    return {FIELDS : {'pH' : n} if fields else {}, 'n' : n}
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sink = FakeSink()
+        self.breaker = CircuitBreaker('fake', failure_threshold=2,
+                reset_timeout=10, jitter=0, clock=self.clock)
+        self.worker = SinkWorker(self.sink, batch_size=2,
+                breaker=self.breaker)
+        self.sink.breaker = self.breaker
+
+    def write(self, *rows):
+        self.worker._set_aside(list(rows))
+        self.worker._write_backlog()
+
+    def test_open_half_open_closed(self):
+        self.sink.down = True
+        self.write(row(1))
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.write(row(2))
+        self.assertEqual(OPEN, self.breaker.state)
+
+        # Open: no write is attempted, the rows wait in the backlog.
+        self.sink.down = False
+        self.write(row(3))
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertEqual(3, len(self.worker._backlog))
+
+        # The probe fails, the reset timeout doubles.
+        self.clock.now += 10
+        self.sink.down = True
+        self.write()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertEqual(self.clock.now + 20, self.breaker.retry_at)
+
+        self.clock.now += 20
+        self.sink.down = False
+        self.write()
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.assertEqual([CLOSED, CLOSED, HALF_OPEN, HALF_OPEN, CLOSED],
+                self.sink.states)
+        self.assertEqual([1, 2, 3], [r['n'] for r in self.sink.rows])
+        self.assertEqual(0, len(self.worker._backlog))
+        self.assertEqual(2, self.breaker.trips)
+
+    def test_rejected_batch_is_dropped(self):
+        self.write(row(1, fields=False), row(2))
+        self.write(row(3))
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.assertEqual(0, self.breaker.trips)
+        self.assertEqual([3], [r['n'] for r in self.sink.rows])
+        self.assertEqual(2, self.worker.failed)
+        self.assertEqual(1, self.worker.failed_batches)
+        self.assertEqual(0, len(self.worker._backlog))
+
+    def test_rejected_probe_closes(self):
+        self.sink.down = True
+        self.write(row(1))
+        self.write(row(2))
+        self.assertEqual(OPEN, self.breaker.state)
+
+        self.clock.now += 10
+        self.sink.down = False
+        self.worker._backlog.clear()
+        self.write(row(3, fields=False))
+        self.write(row(4))
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.assertEqual([4], [r['n'] for r in self.sink.rows])
+        self.assertEqual(1, self.worker.failed)
+
+    def test_rejected_without_breaker(self):
+        worker = SinkWorker(self.sink, retry_delay=0)
+        self.assertFalse(worker._write([row(1, fields=False)]))
+        self.assertTrue(worker._write([row(2)]))
+        self.assertEqual(1, worker.failed)
+        self.assertEqual(1, worker.written)
+
+
+class FailingClient(object):
+    def __init__(self, error):
+        self.error = error
+
+    def write_points(self, rows):
+        raise self.error
+
+
+@unittest.skipIf(InfluxDBClientError is None, 'influxdb not installed')
+class InfluxSinkTest(unittest.TestCase):
+
+    def write(self, error):
+        sink = InfluxSink('db', lambda: FailingClient(error))
+        sink.open()
+        sink.write([row(1)])
+
+    def test_client_error_rejected(self):
+        with self.assertRaises(RejectedError):
+            self.write(InfluxDBClientError('field type conflict', 400))
+
+    def test_server_error_retried(self):
+        for error in (InfluxDBServerError('timeout'),
+                InfluxDBClientError('unknown')):
+            with self.assertRaises(SinkError) as cm:
+                self.write(error)
+            self.assertNotIsInstance(cm.exception, RejectedError)
+
+
+if '__main__' == __name__:
+    unittest.main()